@@ -0,0 +1,123 @@
+import os
+import re
+from collections import defaultdict
+
+from constants import BATCH_MAX_FILES, BATCH_SMALL_FILE_TOKENS, DEFAULT_MAX_TOKENS, FILE_TYPE_TOKENS
+from token_counter import estimate_tokens
+
+FILE_START = "<<<FILE {}>>>"
+FILE_END = "<<<END FILE>>>"
+FILE_PATTERN = re.compile(r"^<<<FILE (.+?)>>>[ \t]*\n(.*?)\n?^<<<END FILE>>>", re.MULTILINE | re.DOTALL)
+# the reply has to fit into max_tokens with room to spare, a batch cut off at the end loses its last file
+BATCH_MAX_TOKENS = DEFAULT_MAX_TOKENS * 3 // 4
+
+
+def expected_tokens(filename: str) -> int:
+    return FILE_TYPE_TOKENS.get(os.path.splitext(filename)[1].lower(), FILE_TYPE_TOKENS["default"])
+
+
+def plan_batches(
+    files: list[str], max_files: int = BATCH_MAX_FILES, max_tokens: int = BATCH_MAX_TOKENS
+) -> list[list[str]]:
+    """
+    Groups small files of the same type (neighbours in the directory tree next to each other) into batches that are
+    generated with one request. Big files, and small files that end up alone, form batches of one.
+    """
+    batches = []
+    small_files_by_type = defaultdict(list)
+    for filename in files:
+        if expected_tokens(filename) > BATCH_SMALL_FILE_TOKENS:
+            batches.append([filename])
+        else:
+            small_files_by_type[os.path.splitext(filename)[1].lower()].append(filename)
+
+    for same_type in small_files_by_type.values():
+        batch, batch_tokens = [], 0
+        for filename in sorted(same_type):
+            tokens = expected_tokens(filename)
+            if batch and (len(batch) >= max_files or batch_tokens + tokens > max_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(filename)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+    return batches
+
+
+def batch_system_prompt(prompt: str, filepaths_string: str, shared_dependencies: str) -> str:
+    # the same prefix the per-file requests send, which is the part batching sends once instead of once per file
+    return f"""You are an AI developer who is trying to write a program that will generate code for the user based on \
+their intent.
+
+the app is: {prompt}
+
+the files we have decided to generate are: {filepaths_string}
+
+the shared dependencies (like filenames and variable names) we have decided on are: {shared_dependencies}
+
+only write valid code for the given filepaths and file types, and return only the code.
+do not add any other explanation, only return valid code for those file types."""
+
+
+def batch_user_prompt(files: list[str], prompt: str) -> str:
+    file_list = "\n".join(f"   - {filename}" for filename in files)
+    return f"""We have broken up the program into per-file generation.
+Now your job is to generate only the code for these files:
+{file_list}
+Make sure to have consistent filenames if you reference other files we are also generating.
+
+Remember that you must obey 3 things:
+   - you are generating code for exactly the files listed above, each one of them complete
+   - do not stray from the names of the files and the shared dependencies we have decided on
+   - MOST IMPORTANT OF ALL - the purpose of our app is {prompt} - every line of code you generate must be valid code. \
+Do not include code fences in your response.
+
+Put every file between these two lines, and nothing outside of them:
+{FILE_START.format("path/of/the/file")}
+{FILE_END}
+
+Begin generating the code now."""
+
+
+def parse_batch(reply: str, files: list[str]) -> dict[str, str]:
+    """
+    The code of every file of the batch that came back complete, by filename. Files that are missing (e.g. because
+    the reply was cut off) are left out, for the caller to generate one by one.
+    """
+    wanted = {os.path.normpath(filename.strip()): filename for filename in files}
+    codes = {}
+    for match in FILE_PATTERN.finditer(reply):
+        filename = wanted.get(os.path.normpath(match.group(1).strip().strip("`'\"")))
+        if filename is not None and filename not in codes:
+            codes[filename] = match.group(2)
+    return codes
+
+
+class BatchStats:
+    """Counts the prompt prefixes that batching did not have to send, compared to one request per file."""
+
+    def __init__(self) -> None:
+        self.files = 0
+        self.batch_requests = 0
+        self.single_requests = 0
+        self.fallbacks = 0
+        self.prefix_tokens_saved = 0
+
+    def record_batch(self, batch_size: int, parsed: int, prefix: str) -> None:
+        self.files += batch_size
+        self.batch_requests += 1
+        self.fallbacks += batch_size - parsed
+        # one request instead of one per file that came back, the ones that didn't cost a request each anyway
+        self.prefix_tokens_saved += (parsed - 1) * estimate_tokens(prefix)
+
+    def record_single(self) -> None:
+        self.files += 1
+        self.single_requests += 1
+
+    def report(self) -> str:
+        return (
+            f"batching: {self.files} files in {self.batch_requests} batched and "
+            f"{self.single_requests + self.fallbacks} single requests ({self.fallbacks} fell back from a batch), "
+            f"~{self.prefix_tokens_saved} prompt tokens saved"
+        )
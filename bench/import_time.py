@@ -0,0 +1,67 @@
+"""
+Measures how long the entry points take to import, each in a fresh interpreter, and which of their imports cost the
+most (from `python -X importtime`).
+
+    python -m bench.import_time
+    python -m bench.import_time main debugger_no_modal --top 20
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["main", "main_no_modal", "debugger_no_modal", "debugger", "code2prompt"]
+RUNS = 3 # the fastest of these counts, the others absorb the noise of a cold disk cache
+
+
+def measure(module: str) -> tuple[float, list[tuple[int, str]], str]:
+    """Returns the fastest wall time of importing the module, its heaviest imports (microseconds, self time) and the
+    error, if it fails to import."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    best = float("inf")
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=REPO_ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        best = min(best, time.perf_counter() - started)
+        if completed.returncode != 0:
+            return best, [], completed.stderr.strip().splitlines()[-1]
+
+    imports = []
+    for line in completed.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        imports.append((int(self_us), name.strip()))
+    return best, sorted(imports, reverse=True), ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="measure the import time of the entry points")
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--top", type=int, default=10, help="how many of the heaviest imports to show")
+    args = parser.parse_args()
+
+    # the baseline every entry point pays anyway
+    interpreter, _, _ = measure("sys")
+    print(f"bare interpreter: {interpreter:.3f}s")
+    for module in args.modules:
+        wall_time, imports, error = measure(module)
+        if error:
+            print(f"{module}: failed to import ({error})")
+            continue
+        print(f"{module}: {wall_time:.3f}s ({wall_time - interpreter:.3f}s over the bare interpreter)")
+        for self_us, name in imports[: args.top]:
+            print(f"  {self_us / 1000:8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""
+A local stand-in for the OpenAI Chat Completions endpoint, for benchmarking without network access.
+
+It answers the prompts of the smol developer in kind (a python list of N filepaths for the planning prompt, text for
+the shared dependencies and the debuggers, filler code of a configurable size for every file), with a configurable
+latency distribution, injected 429s and optional SSE streaming. It keeps track of how many requests were in flight at
+once and of the latency of every kind of request, which the harness reads back from `GET /stats`.
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+STREAM_CHUNK_CHARS = 40 # roughly what a handful of tokens per SSE event comes to
+
+
+# each distribution turns the configured mean latency (in seconds) into a sample
+LATENCY_DISTRIBUTIONS = {
+    "constant": lambda rng, mean, sigma: mean,
+    "uniform": lambda rng, mean, sigma: rng.uniform(0, 2 * mean),
+    "exponential": lambda rng, mean, sigma: rng.expovariate(1 / mean) if mean > 0 else 0.0,
+    # long tailed like the real API, `sigma` sets how long the tail is
+    "lognormal": lambda rng, mean, sigma: rng.lognormvariate(math.log(mean) - sigma**2 / 2, sigma) if mean > 0 else 0.0,
+}
+
+
+@dataclass
+class MockConfig:
+    plan_files: int = 5
+    latency: str = "lognormal"
+    latency_mean: float = 0.5 # seconds until the whole response is there
+    latency_sigma: float = 0.5
+    rate_limit_probability: float = 0.0 # share of requests answered with a 429
+    retry_after: float = 1.0 # seconds, sent along with every 429
+    concurrency_limit: Optional[int] = None # requests beyond this many in flight get a 429 too
+    response_chars: int = 2000 # average size of a generated file
+    seed: Optional[int] = None
+
+
+@dataclass
+class _KindStats:
+    requests: int = 0
+    first_start: Optional[float] = None
+    last_end: Optional[float] = None
+    latencies: list[float] = field(default_factory=list)
+
+
+class MockState:
+    def __init__(self, config: MockConfig) -> None:
+        self.lock = threading.Lock()
+        self.reset(config)
+
+    def reset(self, config: MockConfig) -> None:
+        with self.lock:
+            self.config = config
+            self.rng = random.Random(config.seed)
+            self.started = time.monotonic()
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            # integral of the number of requests in flight over time, for the average concurrency
+            self.in_flight_seconds = 0.0
+            self.last_change = self.started
+            self.rate_limited = 0
+            self.kinds: dict[str, _KindStats] = {}
+
+    def _account(self, now: float) -> None:
+        self.in_flight_seconds += self.in_flight * (now - self.last_change)
+        self.last_change = now
+
+    def enter(self, kind: str) -> tuple[bool, float]:
+        """Returns whether to answer the request with a 429, and how long the response should take."""
+        with self.lock:
+            now = time.monotonic()
+            stats = self.kinds.setdefault(kind, _KindStats())
+            stats.requests += 1
+            if stats.first_start is None:
+                stats.first_start = now
+            over_limit = self.config.concurrency_limit is not None and self.in_flight >= self.config.concurrency_limit
+            if over_limit or self.rng.random() < self.config.rate_limit_probability:
+                self.rate_limited += 1
+                return True, 0.0
+            self._account(now)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            sample = LATENCY_DISTRIBUTIONS[self.config.latency]
+            return False, max(0.0, sample(self.rng, self.config.latency_mean, self.config.latency_sigma))
+
+    def leave(self, kind: str, started: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self._account(now)
+            self.in_flight -= 1
+            stats = self.kinds[kind]
+            stats.last_end = now
+            stats.latencies.append(now - started)
+
+    def file_size(self) -> int:
+        with self.lock:
+            return max(1, int(self.rng.uniform(0.5, 1.5) * self.config.response_chars))
+
+    def stats(self) -> dict:
+        with self.lock:
+            now = time.monotonic()
+            self._account(now)
+            elapsed = now - self.started
+            kinds = {}
+            for kind, stats in self.kinds.items():
+                latencies = sorted(stats.latencies)
+                kinds[kind] = {
+                    "requests": stats.requests,
+                    "span": (stats.last_end - stats.first_start) if stats.last_end is not None else None,
+                    "p50": _percentile(latencies, 0.5),
+                    "p95": _percentile(latencies, 0.95),
+                    "max": latencies[-1] if latencies else None,
+                }
+            return {
+                "config": asdict(self.config),
+                "elapsed": elapsed,
+                "peak_in_flight": self.peak_in_flight,
+                "mean_in_flight": self.in_flight_seconds / elapsed if elapsed > 0 else 0.0,
+                "rate_limited": self.rate_limited,
+                "kinds": kinds,
+            }
+
+
+def _percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def request_kind(messages: list[dict]) -> str:
+    """Which of the prompts of the smol developer this is, going by its system prompt."""
+    system_prompt = messages[0]["content"] if messages else ""
+    if "return them as a python list of strings" in system_prompt:
+        return "filepaths"
+    if "what dependencies they share" in system_prompt:
+        return "shared_dependencies"
+    if "generate code" in system_prompt:
+        return "files"
+    return "debug"
+
+
+def reply_for(kind: str, state: MockState) -> str:
+    if kind == "filepaths":
+        # nested directories, so that directory creation is part of what gets measured
+        return repr([f"src/module_{i // 10}/file_{i}.py" for i in range(state.config.plan_files)])
+    if kind == "shared_dependencies":
+        return "\n".join(f"- `shared_name_{i}`: used across the files" for i in range(20))
+    size = state.file_size() if kind == "files" else state.config.response_chars
+    line = "print('the quick brown fox jumps over the lazy dog')\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    server: "MockOpenAIServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.server.state.stats())
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self) -> None:
+        path = self.path.rstrip("/")
+        if path.endswith("/reset"):
+            self.server.state.reset(MockConfig(**self._read_json()))
+            self._send_json(200, {})
+        elif path.endswith("/chat/completions"):
+            self._chat_completion(self._read_json())
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def _chat_completion(self, body: dict) -> None:
+        state = self.server.state
+        kind = request_kind(body.get("messages", []))
+        rate_limited, latency = state.enter(kind)
+        if rate_limited:
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                headers={"Retry-After": str(state.config.retry_after)},
+            )
+            return
+
+        started = time.monotonic()
+        try:
+            reply = reply_for(kind, state)
+            completion_id = "chatcmpl-" + uuid.uuid4().hex
+            model = body.get("model", "mock")
+            if body.get("stream"):
+                self._stream(reply, latency, completion_id, model)
+            else:
+                time.sleep(latency)
+                self._send_json(
+                    200,
+                    {
+                        "id": completion_id,
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}
+                        ],
+                        "usage": {"prompt_tokens": 0, "completion_tokens": len(reply) // 4, "total_tokens": 0},
+                    },
+                )
+        finally:
+            state.leave(kind, started)
+
+    def _stream(self, reply: str, latency: float, completion_id: str, model: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        chunks = [reply[i : i + STREAM_CHUNK_CHARS] for i in range(0, len(reply), STREAM_CHUNK_CHARS)]
+        # the latency is spread over the chunks, like tokens trickling in
+        delay = latency / (len(chunks) + 1)
+        deltas = [{"role": "assistant"}] + [{"content": chunk} for chunk in chunks]
+        for i, delta in enumerate(deltas):
+            time.sleep(delay)
+            event = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if i == len(deltas) - 1 else None}],
+            }
+            self.wfile.write(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # hundreds of concurrent requests of a 500 file plan must not be refused by a short listen backlog
+    request_queue_size = 1024
+
+    def __init__(self, address: tuple[str, int], config: MockConfig) -> None:
+        super().__init__(address, MockOpenAIHandler)
+        self.state = MockState(config)
+
+    @property
+    def api_base(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="mock_openai", daemon=True)
+        thread.start()
+        return thread
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = MockConfig()
+    parser.add_argument("--latency", choices=sorted(LATENCY_DISTRIBUTIONS), default=defaults.latency)
+    parser.add_argument("--latency-mean", type=float, default=defaults.latency_mean, help="seconds")
+    parser.add_argument("--latency-sigma", type=float, default=defaults.latency_sigma, help="tail of lognormal")
+    parser.add_argument("--rate-limit-probability", type=float, default=defaults.rate_limit_probability)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after, help="seconds")
+    parser.add_argument("--concurrency-limit", type=int, default=defaults.concurrency_limit)
+    parser.add_argument("--response-chars", type=int, default=defaults.response_chars)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def config_from_arguments(args: argparse.Namespace, **overrides) -> MockConfig:
+    config = {name: getattr(args, name) for name in MockConfig.__dataclass_fields__ if hasattr(args, name)}
+    config.update(overrides)
+    return MockConfig(**config)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve a mock OpenAI Chat Completions API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--plan-files", type=int, default=MockConfig.plan_files)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockOpenAIServer(("127.0.0.1", args.port), config_from_arguments(args))
+    print(f"mock OpenAI API at {server.api_base}, set OPENAI_API_BASE to it")
+    server.serve_forever()
@@ -0,0 +1,165 @@
+"""
+Benchmarks the smol developer end to end against the local mock OpenAI server (see mock_openai.py), no network needed.
+
+    python -m bench.run                                  # every target, plans of 5, 50 and 500 files
+    python -m bench.run --targets main_no_modal --files 50 --rate-limit-probability 0.05 --json before.json
+
+Every run happens in a fresh subprocess and a fresh working directory, so that peak RSS is that of the run alone and
+no cache, manifest or scan index of an earlier run is reused. Reported per run: wall time, the span and latency of
+every stage (as seen by the mock: planning, shared dependencies, files, debugging), the achieved concurrency and the
+peak RSS.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.mock_openai import MockOpenAIServer, add_config_arguments, config_from_arguments
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGETS = ["smol_ai", "main_no_modal", "debugger_no_modal"]
+DEFAULT_PLAN_SIZES = [5, 50, 500]
+RESULT_PREFIX = "BENCH_RESULT "
+BENCH_PROMPT = "a todo list app with a python backend and a web frontend"
+BENCH_ERROR = "TypeError: 'NoneType' object is not subscriptable"
+
+
+def run_target(target: str, directory: str, concurrency: int) -> None:
+    if target == "smol_ai":
+        import main
+
+        asyncio.run(main.run_cli(main.SmolAI(prompt=BENCH_PROMPT, directory=directory)))
+    elif target == "main_no_modal":
+        import main_no_modal
+
+        main_no_modal.main(BENCH_PROMPT, directory, concurrency=concurrency)
+    elif target == "debugger_no_modal":
+        import debugger_no_modal
+        from constants import DEFAULT_MODEL
+
+        debugger_no_modal.main(argparse.Namespace(prompt=BENCH_ERROR, directory=directory, model=DEFAULT_MODEL))
+    else:
+        raise ValueError(f"unknown target {target!r}")
+
+
+def child(target: str, directory: str, concurrency: int) -> None:
+    started = time.monotonic()
+    run_target(target, directory, concurrency)
+    wall_time = time.monotonic() - started
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    peak_rss_mb = max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+    print(RESULT_PREFIX + json.dumps({"wall_time": wall_time, "peak_rss_mb": peak_rss_mb}))
+
+
+def make_debug_directory(directory: str, files: int, chars: int) -> None:
+    """The debuggers read an existing codebase, this makes one up the size of a generated plan."""
+    line = "print('the quick brown fox jumps over the lazy dog')\n"
+    for i in range(files):
+        file_path = os.path.join(directory, f"src/module_{i // 10}/file_{i}.py")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as file:
+            file.write((line * (chars // len(line) + 1))[:chars])
+
+
+def bench(server: MockOpenAIServer, args: argparse.Namespace, target: str, files: int) -> dict:
+    workdir = tempfile.mkdtemp(prefix="smol_bench_")
+    try:
+        directory = os.path.join(workdir, "generated")
+        if target == "debugger_no_modal":
+            make_debug_directory(directory, files, args.response_chars)
+        server.state.reset(config_from_arguments(args, plan_files=files))
+
+        env = dict(os.environ)
+        env.pop("PROMPTLAYER_API_KEY", None)
+        env.update(
+            OPENAI_API_BASE=server.api_base,
+            OPENAI_API_KEY="sk-mock",
+            PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")])),
+            # every run starts cold, and tiktoken must not go downloading its encodings
+            SMOL_CACHE="off",
+            SMOL_COUNT_TOKENS="0",
+        )
+        command = [sys.executable, "-m", "bench.run", "--child", target, "--directory", directory]
+        command += ["--concurrency", str(args.concurrency)]
+        completed = subprocess.run(command, cwd=workdir, env=env, capture_output=True, text=True)
+        if args.verbose or completed.returncode != 0:
+            sys.stdout.write(completed.stdout)
+            sys.stderr.write(completed.stderr)
+
+        result = {"target": target, "files": files, "ok": completed.returncode == 0}
+        for line in completed.stdout.splitlines():
+            if line.startswith(RESULT_PREFIX):
+                result.update(json.loads(line[len(RESULT_PREFIX) :]))
+        result["mock"] = server.state.stats()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _seconds(value) -> str:
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def report(result: dict) -> str:
+    mock = result["mock"]
+    lines = [
+        f"{result['target']} with {result['files']} files: "
+        + (f"{result['wall_time']:.2f}s wall" if "wall_time" in result else "FAILED")
+        + (f", peak RSS {result['peak_rss_mb']:.0f} MB" if "peak_rss_mb" in result else "")
+        + f", concurrency peak {mock['peak_in_flight']} / mean {mock['mean_in_flight']:.1f}"
+        + f", {mock['rate_limited']} rate limited"
+    ]
+    for kind, stats in mock["kinds"].items():
+        lines.append(
+            f"  {kind}: {stats['requests']} requests over {_seconds(stats['span'])}, "
+            f"p50 {_seconds(stats['p50'])}, p95 {_seconds(stats['p95'])}, max {_seconds(stats['max'])}"
+        )
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="benchmark the smol developer against a local mock OpenAI API")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--files", nargs="+", type=int, default=DEFAULT_PLAN_SIZES, help="plan sizes to run")
+    parser.add_argument("--concurrency", type=int, default=None, help="for main_no_modal, its own default if unset")
+    parser.add_argument("--json", help="also write the results to this file, e.g. to compare before and after")
+    parser.add_argument("--verbose", "-v", action="store_true", help="show the output of the runs")
+    parser.add_argument("--child", choices=TARGETS, help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.concurrency is None:
+        from constants import DEFAULT_CONCURRENCY
+
+        args.concurrency = DEFAULT_CONCURRENCY
+    if args.child:
+        child(args.child, args.directory, args.concurrency)
+        return
+
+    server = MockOpenAIServer(("127.0.0.1", 0), config_from_arguments(args))
+    server.start()
+    results = []
+    try:
+        for target in args.targets:
+            for files in args.files:
+                result = bench(server, args, target, files)
+                print(report(result))
+                results.append(result)
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+import asyncio
+import functools
+import io
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from botmerger import InMemoryBotMerger
+
+from constants import (
+    DEFAULT_CACHE_DIR,
+    MERGER_LARGE_PAYLOAD_CHARS,
+    MERGER_MAX_PER_CHANNEL,
+    MERGER_MAX_UNSPILLABLE,
+    MERGER_SPILL_MAX_AGE,
+    MERGER_TTL,
+)
+from file_writer import io_executor, run_io
+
+SPILL_CLEANUP_INTERVAL = 60 * 60 # seconds
+MERGER_REFERENCE = "merger"
+OBJECT_REFERENCE = "object"
+
+
+@dataclass
+class _Entry:
+    value: Any
+    registered: float
+    channel: Any
+
+
+class _SpillPickler(pickle.Pickler):
+    """
+    Messages point at the merger, their bots, channels and other messages, which must not be pickled along with them
+    (they'd come back as detached copies), they are stored as their key in the merger instead.
+    """
+
+    def __init__(self, file, merger: "BoundedBotMerger", root: Any) -> None:
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.merger = merger
+        self.root = root
+
+    def persistent_id(self, obj: Any) -> Any:
+        if obj is self.merger:
+            return MERGER_REFERENCE
+        if obj is self.root:
+            return None
+        key = self.merger._keys_by_id.get(id(obj))
+        return (OBJECT_REFERENCE, key) if key is not None else None
+
+
+class _SpillUnpickler(pickle.Unpickler):
+    def __init__(self, file, merger: "BoundedBotMerger") -> None:
+        super().__init__(file)
+        self.merger = merger
+
+    def persistent_load(self, pid: Any) -> Any:
+        if pid == MERGER_REFERENCE:
+            return self.merger
+        if isinstance(pid, tuple) and len(pid) == 2 and pid[0] == OBJECT_REFERENCE:
+            return self.merger._lookup(pid[1])
+        raise pickle.UnpicklingError(f"unknown persistent id {pid!r}")
+
+
+def _channel_key(channel: Any) -> Any:
+    return getattr(channel, "uuid", None) or id(channel)
+
+
+def _payload_size(value: Any) -> int:
+    content = getattr(value, "content", None)
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, dict):
+        return sum(len(item) for item in content.values() if isinstance(item, str))
+    return 0
+
+
+class BoundedBotMerger(InMemoryBotMerger):
+    """
+    An `InMemoryBotMerger` that doesn't keep every message for the lifetime of the process. Messages are kept in
+    memory for `ttl` seconds and up to `max_per_channel` per channel; older ones (and any message with a payload
+    bigger than `large_payload_chars`, e.g. a whole generated file) are spilled to SQLite and only loaded back when
+    somebody asks for them. Bots and channels are few and always stay in memory. Without a `spill_path` evicted
+    messages are simply dropped, messages that can't be spilled are kept in memory rather than dropped (up to
+    `max_unspillable` of them).
+
+    Nothing is evicted from a channel while a bot (see `keep_in_flight`) is still working on a request in it: a run
+    reads its messages back until it is over, however many it produces along the way.
+    """
+
+    def __init__(
+        self,
+        *args,
+        ttl: float = MERGER_TTL,
+        max_per_channel: int = MERGER_MAX_PER_CHANNEL,
+        large_payload_chars: int = MERGER_LARGE_PAYLOAD_CHARS,
+        max_unspillable: int = MERGER_MAX_UNSPILLABLE,
+        spill_path: Optional[str] = os.path.join(DEFAULT_CACHE_DIR, "merger.sqlite"),
+        spill_max_age: float = MERGER_SPILL_MAX_AGE,
+        **kwargs,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.ttl = ttl
+        self.max_per_channel = max_per_channel
+        self.large_payload_chars = large_payload_chars
+        self.max_unspillable = max_unspillable
+        self.spill_path = spill_path
+        self.spill_max_age = spill_max_age
+
+        self._pinned: dict[Any, Any] = {}
+        # messages in the order they were registered, oldest first
+        self._messages: OrderedDict[Any, _Entry] = OrderedDict()
+        self._channel_messages: dict[Any, deque] = {}
+        # messages on their way to disk, readable from memory until they are there
+        self._spilling: dict[Any, Any] = {}
+        # messages that would have been spilled but can't be pickled, the oldest beyond `max_unspillable` are dropped
+        # after all
+        self._unspillable: OrderedDict[Any, Any] = OrderedDict()
+        # the keys of the objects in memory by their id, so that spilled messages refer to them by key
+        self._keys_by_id: dict[int, Any] = {}
+        # requests bots are working on, by channel
+        self._in_flight: dict[Any, int] = {}
+        self.spilled = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+        # opened when the first message is spilled, not when the merger is created
+        self._spill: Optional[sqlite3.Connection] = None
+        self._last_cleanup = 0.0
+
+    @classmethod
+    def from_env(cls, *args, **kwargs) -> "BoundedBotMerger":
+        return cls(
+            *args,
+            ttl=float(os.environ.get("SMOL_MERGER_TTL", MERGER_TTL)),
+            max_per_channel=int(os.environ.get("SMOL_MERGER_MAX_PER_CHANNEL", MERGER_MAX_PER_CHANNEL)),
+            spill_path=None if os.environ.get("SMOL_MERGER_SPILL", "1") == "0" else os.path.join(
+                os.environ.get("SMOL_CACHE_DIR", DEFAULT_CACHE_DIR), "merger.sqlite"
+            ),
+            **kwargs,
+        )
+
+    def keep_in_flight(self, fn):
+        """Keeps the messages of the channel the bot is working in in memory until the bot is done."""
+
+        @functools.wraps(fn)
+        async def wrapper(context) -> None:
+            channel_key = _channel_key(context.channel)
+            self._in_flight[channel_key] = self._in_flight.get(channel_key, 0) + 1
+            try:
+                await fn(context)
+            finally:
+                self._in_flight[channel_key] -= 1
+                if not self._in_flight[channel_key]:
+                    del self._in_flight[channel_key]
+                    self._trim_channel(channel_key)
+
+        return wrapper
+
+    async def _register_object(self, key: Any, value: Any) -> None:
+        self._keys_by_id[id(value)] = key
+        channel = getattr(value, "channel", None)
+        if channel is None or not hasattr(value, "content"):
+            self._pinned[key] = value
+            return
+
+        now = time.time()
+        channel_key = _channel_key(channel)
+        self._messages[key] = _Entry(value, now, channel_key)
+        self._channel_messages.setdefault(channel_key, deque()).append(key)
+        if channel_key not in self._in_flight:
+            self._trim_channel(channel_key)
+
+        expired = []
+        for old_key, entry in self._messages.items():
+            if now - entry.registered <= self.ttl:
+                break
+            if entry.channel not in self._in_flight:
+                expired.append((old_key, entry))
+        for old_key, entry in expired:
+            self._remove(old_key, entry)
+
+    async def _get_object(self, key: Any) -> Optional[Any]:
+        value = self._lookup_in_memory(key)
+        if value is not None:
+            return value
+        return await run_io(self._load, key)
+
+    def _lookup_in_memory(self, key: Any) -> Optional[Any]:
+        if key in self._pinned:
+            return self._pinned[key]
+        entry = self._messages.get(key)
+        if entry is not None:
+            return entry.value
+        if key in self._spilling:
+            return self._spilling[key]
+        return self._unspillable.get(key)
+
+    def _lookup(self, key: Any) -> Optional[Any]:
+        value = self._lookup_in_memory(key)
+        return value if value is not None else self._load(key)
+
+    def _trim_channel(self, channel_key: Any) -> None:
+        """Evicts the big messages of a channel nobody is working in, and the oldest ones beyond the limit."""
+        channel_messages = self._channel_messages.get(channel_key)
+        if channel_messages is None:
+            return
+        if self.spill_path:
+            # kept by reference only, the payload itself lives on disk
+            large = [
+                key
+                for key in channel_messages
+                if _payload_size(self._messages[key].value) > self.large_payload_chars
+            ]
+            for key in large:
+                self._remove(key, self._messages[key])
+        while len(channel_messages) > self.max_per_channel:
+            old_key = channel_messages[0]
+            self._remove(old_key, self._messages[old_key])
+
+    def _remove(self, key: Any, entry: _Entry) -> None:
+        del self._messages[key]
+        self._forget_channel_message(entry.channel, key)
+        self._keys_by_id.pop(id(entry.value), None)
+        self._evict(key, entry)
+
+    def _forget_channel_message(self, channel_key: Any, key: Any) -> None:
+        channel_messages = self._channel_messages.get(channel_key)
+        if channel_messages is None:
+            return
+        try:
+            channel_messages.remove(key)
+        except ValueError:
+            pass
+        if not channel_messages:
+            del self._channel_messages[channel_key]
+
+    def _evict(self, key: Any, entry: _Entry) -> None:
+        if not self.spill_path:
+            self.dropped += 1
+            return
+        # pickling (big payloads, mostly) and writing happen on the I/O executor, never on the event loop
+        self._spilling[key] = entry.value
+        future = asyncio.get_running_loop().run_in_executor(io_executor, self._write_spill, key, entry)
+        future.add_done_callback(functools.partial(self._on_spilled, key, entry))
+
+    def _on_spilled(self, key: Any, entry: _Entry, future: asyncio.Future) -> None:
+        self._spilling.pop(key, None)
+        if not future.cancelled() and future.exception() is None and future.result():
+            self.spilled += 1
+            return
+        # something in the message can't go to disk (a lock, a coroutine...), it stays in memory instead
+        self._unspillable[key] = entry.value
+        self._keys_by_id[id(entry.value)] = key
+        while len(self._unspillable) > self.max_unspillable:
+            _, value = self._unspillable.popitem(last=False)
+            self._keys_by_id.pop(id(value), None)
+            self.dropped += 1
+
+    def _write_spill(self, key: Any, entry: _Entry) -> bool:
+        """Pickles the message into the spill database, returns whether it could be pickled."""
+        file = io.BytesIO()
+        try:
+            _SpillPickler(file, self, entry.value).dump(entry.value)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO objects (key, registered, value) VALUES (?, ?, ?)",
+                (str(key), entry.registered, file.getvalue()),
+            )
+            if entry.registered - self._last_cleanup > SPILL_CLEANUP_INTERVAL:
+                expired = entry.registered - self.spill_max_age
+                self._spill.execute("DELETE FROM objects WHERE registered < ?", (expired,))
+                self._last_cleanup = entry.registered
+        return True
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._spill is None:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            self._spill = sqlite3.connect(self.spill_path, check_same_thread=False, isolation_level=None)
+            self._spill.execute(
+                "CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, registered REAL NOT NULL, value BLOB)"
+            )
+        return self._spill
+
+    def _load(self, key: Any) -> Optional[Any]:
+        if self._spill is None:
+            # nothing was spilled in this process, and the spill file of an earlier one is of no use
+            return None
+        with self._lock:
+            row = self._spill.execute("SELECT value FROM objects WHERE key = ?", (str(key),)).fetchone()
+        if row is None:
+            return None
+        return _SpillUnpickler(io.BytesIO(row[0]), self).load()
+
+    def stats(self) -> str:
+        return (
+            f"merger: {len(self._messages)} messages in memory in {len(self._channel_messages)} channels, "
+            f"{self.spilled} spilled to disk, {len(self._unspillable)} kept in memory as they can't be spilled, "
+            f"{self.dropped} dropped"
+        )
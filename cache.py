@@ -0,0 +1,229 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Awaitable, Callable, Optional, Type
+
+from constants import CACHE_MAX_AGE, CACHE_MAX_BYTES, DEFAULT_CACHE_DIR
+from file_writer import run_io
+
+CACHE_MODES = ("on", "off", "refresh")
+EVICTION_INTERVAL = 60 # seconds
+
+
+class ResponseCache:
+    """
+    On-disk, content-addressed cache of chat completion replies.
+
+    Entries are keyed by a hash of model, messages, max_tokens and temperature. Eviction is LRU by total size and
+    by age (an entry's mtime is bumped every time it is read). Mode "off" bypasses the cache entirely, "refresh"
+    skips lookups but still stores fresh replies. Identical requests that are in flight at the same time collapse
+    into one upstream call, both for asyncio tasks and for threads.
+    """
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_CACHE_DIR,
+        max_bytes: int = CACHE_MAX_BYTES,
+        max_age: float = CACHE_MAX_AGE,
+        mode: str = "on",
+    ) -> None:
+        if mode not in CACHE_MODES:
+            raise ValueError(f"cache mode must be one of {CACHE_MODES}, got {mode!r}")
+        self.directory = os.path.join(directory, "responses")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.mode = mode
+
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+
+        self._last_eviction = 0.0
+        self._lock = threading.Lock()
+        self._async_in_flight: dict[str, asyncio.Future] = {}
+        self._sync_in_flight: dict[str, concurrent.futures.Future] = {}
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        return cls(
+            directory=os.environ.get("SMOL_CACHE_DIR", DEFAULT_CACHE_DIR),
+            mode=os.environ.get("SMOL_CACHE", "on").lower(),
+        )
+
+    @staticmethod
+    def key(params: dict) -> str:
+        payload = {
+            "model": params["model"],
+            "messages": params["messages"],
+            "max_tokens": params.get("max_tokens"),
+            "temperature": params.get("temperature"),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> Optional[str]:
+        if self.mode != "on":
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as file:
+                reply = json.load(file)["reply"]
+            # bump mtime so that eviction is least-recently-used rather than least-recently-written
+            os.utime(path)
+            return reply
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key: str, reply: str) -> None:
+        if self.mode == "off":
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file first so that a concurrent reader never sees a half-written entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"reply": reply, "created": time.time()}, file)
+        os.replace(tmp_path, path)
+
+        # walking the whole cache on every put would be wasteful, so eviction runs at most once a minute (and on one
+        # of the I/O threads at a time)
+        with self._lock:
+            due = time.time() - self._last_eviction > EVICTION_INTERVAL
+            if due:
+                self._last_eviction = time.time()
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        self._last_eviction = time.time()
+        entries = []
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if now - stat.st_mtime > self.max_age:
+                    _remove_quietly(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove_quietly(path)
+            total -= size
+
+    async def aget_or_create(
+        self,
+        params: dict,
+        create: Callable[[], Awaitable[str]],
+        owner_errors: tuple[Type[BaseException], ...] = (),
+    ) -> str:
+        """
+        The cached reply, or the one `create` makes. A request that is collapsed into an identical one in flight
+        makes the call itself after all if that one fails with one of `owner_errors`, errors that are about whoever
+        made the call (e.g. their run being cancelled) rather than about the request.
+        """
+        if self.mode == "off":
+            return await create()
+        key = self.key(params)
+
+        # the cache is on disk, reading it (and writing it, and evicting from it) never happens on the event loop
+        reply = await run_io(self.get, key)
+        if reply is not None:
+            self.hits += 1
+            return reply
+
+        in_flight = self._async_in_flight.get(key)
+        if in_flight is not None:
+            self.collapsed += 1
+            try:
+                return await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                if not in_flight.cancelled():
+                    raise
+                # the task that was making the call got cancelled, but we still want the reply
+                return await self.aget_or_create(params, create, owner_errors)
+            except owner_errors:
+                return await self.aget_or_create(params, create, owner_errors)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._async_in_flight[key] = future
+        try:
+            try:
+                reply = await create()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as exc:
+                future.set_exception(exc)
+                # the exception is re-raised below, don't let asyncio complain about it never being retrieved
+                future.exception()
+                raise
+            # the requests waiting for the reply don't need to wait for it to be stored as well
+            future.set_result(reply)
+            await run_io(self.put, key, reply)
+            return reply
+        finally:
+            del self._async_in_flight[key]
+
+    def get_or_create(self, params: dict, create: Callable[[], str]) -> str:
+        if self.mode == "off":
+            return create()
+        key = self.key(params)
+
+        reply = self.get(key)
+        if reply is not None:
+            with self._lock:
+                self.hits += 1
+            return reply
+
+        with self._lock:
+            in_flight = self._sync_in_flight.get(key)
+            if in_flight is None:
+                self.misses += 1
+                future = self._sync_in_flight[key] = concurrent.futures.Future()
+            else:
+                self.collapsed += 1
+        if in_flight is not None:
+            return in_flight.result()
+
+        try:
+            reply = create()
+            self.put(key, reply)
+            future.set_result(reply)
+            return reply
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._sync_in_flight[key]
+
+    def stats(self) -> str:
+        return f"cache: {self.hits} hits, {self.misses} misses, {self.collapsed} collapsed in flight"
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+response_cache = ResponseCache.from_env()
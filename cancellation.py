@@ -0,0 +1,149 @@
+import asyncio
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from constants import CALL_TIMEOUT, RUN_DEADLINE
+
+
+class RunCancelled(Exception):
+    def __init__(self, run_id: str, reason: str) -> None:
+        super().__init__(f"run {run_id} {reason}")
+        self.run_id = run_id
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Cancellation of one run. Every bot working on the run (see `cancellable_bot`) runs its task under `guard`, so
+    cancelling the token, or the run's deadline passing, cancels them all at once: in-flight HTTP requests are
+    aborted where they are, file writes that are in progress are abandoned, and `RunCancelled` is raised in their
+    place.
+    """
+
+    def __init__(
+        self,
+        run_id: str,
+        user: Optional[str] = None,
+        deadline: Optional[float] = None,
+        call_timeout: Optional[float] = None,
+    ) -> None:
+        self.run_id = run_id
+        self.user = user
+        self.call_timeout = call_timeout
+        self.deadline = None if deadline is None else time.monotonic() + deadline
+        self.reason: Optional[str] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._timer = None
+        if deadline is not None:
+            self._timer = asyncio.get_running_loop().call_later(
+                deadline, self.cancel, f"ran past its deadline of {deadline:g}s"
+            )
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "was cancelled") -> None:
+        if self.reason is not None:
+            return
+        self.reason = reason
+        self.close()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def check(self) -> None:
+        if self.reason is not None:
+            raise RunCancelled(self.run_id, self.reason)
+
+    def timeout(self) -> Optional[float]:
+        """The timeout of a single OpenAI call, cut short by the run's deadline."""
+        if self.deadline is None:
+            return self.call_timeout
+        remaining = max(0.0, self.deadline - time.monotonic())
+        return remaining if self.call_timeout is None else min(self.call_timeout, remaining)
+
+    @contextmanager
+    def guard(self) -> Iterator["CancelToken"]:
+        """Ties the current task to the token: cancelling the token cancels it, with `RunCancelled` as the result."""
+        self.check()
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            yield self
+        except asyncio.CancelledError:
+            if self.reason is None:
+                # cancelled by someone else, e.g. the whole bot shutting down
+                raise
+            task.uncancel()
+            raise RunCancelled(self.run_id, self.reason) from None
+        finally:
+            self._tasks.discard(task)
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class CancelRegistry:
+    """The cancel tokens of the runs in progress, by run id, which is how they get to every bot working on a run."""
+
+    def __init__(self, run_deadline: Optional[float] = RUN_DEADLINE, call_timeout: Optional[float] = CALL_TIMEOUT):
+        self.run_deadline = run_deadline
+        self.call_timeout = call_timeout
+        self._tokens: dict[str, CancelToken] = {}
+
+    @classmethod
+    def from_env(cls) -> "CancelRegistry":
+        # 0 turns either of them off
+        run_deadline = float(os.environ.get("SMOL_RUN_DEADLINE", RUN_DEADLINE))
+        call_timeout = float(os.environ.get("SMOL_CALL_TIMEOUT", CALL_TIMEOUT))
+        return cls(run_deadline=run_deadline or None, call_timeout=call_timeout or None)
+
+    def open(self, run_id: str, user: Optional[str] = None, deadline: Optional[float] = None) -> CancelToken:
+        # None is the default deadline, 0 is none at all
+        deadline = self.run_deadline if deadline is None else (deadline or None)
+        token = CancelToken(run_id, user, deadline, self.call_timeout)
+        self._tokens[run_id] = token
+        return token
+
+    def get(self, run_id: Optional[str]) -> Optional[CancelToken]:
+        return self._tokens.get(run_id) if run_id is not None else None
+
+    def close(self, run_id: str) -> None:
+        token = self._tokens.pop(run_id, None)
+        if token is not None:
+            token.close()
+
+    def cancel_user(self, user: str, reason: str = "was cancelled") -> int:
+        """Cancels the user's runs, returns how many there were."""
+        tokens = [token for token in self._tokens.values() if token.user == user and not token.cancelled]
+        for token in tokens:
+            token.cancel(reason)
+        return len(tokens)
+
+    def timeout(self, run_id: Optional[str]) -> Optional[float]:
+        token = self.get(run_id)
+        return token.timeout() if token is not None else self.call_timeout
+
+
+cancel_registry = CancelRegistry.from_env()
+
+
+def cancellable_bot(fn):
+    """Runs the bot under the cancel token of the run its request belongs to (the request's `run_id`), if any."""
+
+    @functools.wraps(fn)
+    async def wrapper(context) -> None:
+        content = context.request.content
+        token = cancel_registry.get(content.get("run_id")) if isinstance(content, dict) else None
+        if token is None:
+            await fn(context)
+            return
+        with token.guard():
+            await fn(context)
+
+    return wrapper
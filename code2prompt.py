@@ -1,63 +1,132 @@
 import modal
-import os
-from constants import DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, EXTENSION_TO_SKIP
+from constants import DEFAULT_DIR, DEFAULT_MODEL, MODEL_CONTEXT_WINDOWS
+from llm_client import llm_client
+from retry import retry_policy
+from scan_index import ScanIndex
+from token_counter import COUNT_TOKENS, estimate_tokens
+from utils import chunk_by_tokens
 
 stub = modal.Stub("smol-codetoprompt-v1")
 openai_image = modal.Image.debian_slim().pip_install("openai")
 
 
+CODE2PROMPT_MAX_TOKENS = 2500
+PROMPT_OVERHEAD_TOKENS = 500 # system prompt and instructions around the files
+MIN_REPLY_TOKENS = 256 # map-reduce needs replies of at least this size to describe anything
 
-def read_file(filename):
-    with open(filename, 'r') as file:
-        return file.read()
-
-def walk_directory(directory):
-    code_contents = {}
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if not any(file.endswith(ext) for ext in EXTENSION_TO_SKIP):
-                try:
-                    relative_filepath = os.path.relpath(os.path.join(root, file), directory)
-                    code_contents[relative_filepath] = read_file(os.path.join(root, file))
-                except Exception as e:
-                    code_contents[relative_filepath] = f"Error reading file {file}: {str(e)}"
-    return code_contents
-
+SYSTEM_PROMPT = "You are an AI debugger who is trying to fully describe a program, in order for another AI program to reconstruct every file, data structure, function and functionality. The user has provided you with the following files and their contents:"
+MAP_SYSTEM_PROMPT = "You are an AI debugger who is trying to fully describe a part of a program, in order for another AI program to reconstruct every file, data structure, function and functionality. The user has provided you with some of the program's files and their contents:"
+MERGE_SYSTEM_PROMPT = "You are an AI debugger who is trying to fully describe a program, in order for another AI program to reconstruct every file, data structure, function and functionality. The user has provided you with descriptions of different parts of the program:"
+DESCRIBE_INSTRUCTION = "\n\nDescribe the program in markdown using specific language that will help another AI program reconstruct the given program in as high fidelity as possible."
+DESCRIBE_PART_INSTRUCTION = "\n\nDescribe these files in markdown using specific language that will help another AI program reconstruct them in as high fidelity as possible. Name every file, and keep every name that other files could depend on."
 
 
 @stub.local_entrypoint()
-def main(prompt=None, directory=DEFAULT_DIR, model=DEFAULT_MODEL):
-  code_contents = walk_directory(directory)
+def main(prompt=None, directory=DEFAULT_DIR, model=DEFAULT_MODEL, mode="auto"):
+  # only the files that changed since the last run are read (and their tokens counted) again
+  index = ScanIndex(directory)
+  code_contents = index.scan(model if COUNT_TOKENS else None)
+  print(index.changes.summary())
 
   # Now, `code_contents` is a dictionary that contains the content of all your non-image files
   # You can send this to OpenAI's text-davinci-003 for help
 
-  context = "\n".join(f"{path}:\n{contents}" for path, contents in code_contents.items())
-  system = "You are an AI debugger who is trying to fully describe a program, in order for another AI program to reconstruct every file, data structure, function and functionality. The user has provided you with the following files and their contents:"
-  prompt = "My files are as follows: " + context + "\n\n" + (("Take special note of the following: " + prompt) if prompt else "")
-  prompt += "\n\nDescribe the program in markdown using specific language that will help another AI program reconstruct the given program in as high fidelity as possible."
-  res = generate_response.call(system, prompt, model)
+  # counted when the files were scanned, estimated when token counting is off
+  file_tokens = index.tokens(model)
+  print("\033[37m" + str(sum(file_tokens.values())) + " tokens\033[0m in " + str(len(code_contents)) + " files")
+
+  # how many tokens worth of files fit into one request next to the instructions and the reply
+  context_window = MODEL_CONTEXT_WINDOWS.get(model, MODEL_CONTEXT_WINDOWS["default"])
+  if mode == "auto":
+    single_budget = context_window - CODE2PROMPT_MAX_TOKENS - PROMPT_OVERHEAD_TOKENS
+    mode = "map-reduce" if sum(file_tokens.values()) > single_budget else "single"
+
+  note = ("Take special note of the following: " + prompt) if prompt else ""
+  if mode == "map-reduce":
+    res = describe_in_chunks(code_contents, file_tokens, context_window, note, model)
+  else:
+    context = "\n".join(f"{path}:\n{contents}" for path, contents in code_contents.items())
+    prompt = "My files are as follows: " + context + "\n\n" + note
+    prompt += DESCRIBE_INSTRUCTION
+    res = generate_response.call(SYSTEM_PROMPT, prompt, model)
   # print res in teal
   print("\033[96m" + res + "\033[0m")
 
 
+def describe_in_chunks(code_contents, file_tokens, context_window, note, model):
+  """
+  Map-reduce for codebases that don't fit into the context window: the files are grouped into token-bounded chunks,
+  the chunks are described concurrently, and the partial descriptions are merged (in several rounds, if they don't
+  fit into one request either) into the description of the whole program.
+
+  Every reply is capped at half of what a request may hold, so that any two partial descriptions, and the reply
+  merging them, always fit into one request together.
+  """
+  reply_tokens, chunk_budget = map_reduce_budget(context_window)
+  if reply_tokens < MIN_REPLY_TOKENS:
+    raise ValueError(
+      f"the context window of {model} ({context_window} tokens) is too small to describe the program in parts"
+    )
+  chunks = chunk_by_tokens([(path, file_tokens[path]) for path in code_contents], chunk_budget)
+  print(f"describing {len(code_contents)} files in {len(chunks)} chunks")
+
+  user_prompts = []
+  for chunk in chunks:
+    context = "\n".join(
+      f"{path}:\n{truncate_to_tokens(code_contents[path], file_tokens[path], chunk_budget)}" for path in chunk
+    )
+    user_prompts.append("My files are as follows: " + context + "\n\n" + note + DESCRIBE_PART_INSTRUCTION)
+  partial_descriptions = list(generate_response.map(
+    [MAP_SYSTEM_PROMPT] * len(chunks), user_prompts, [model] * len(chunks), [reply_tokens] * len(chunks)
+  ))
+
+  while True:
+    groups = chunk_by_tokens([(description, estimate_tokens(description)) for description in partial_descriptions], chunk_budget)
+    if len(groups) == 1:
+      break
+    if len(groups) == len(partial_descriptions):
+      # can't happen with replies capped by `map_reduce_budget`, unless the token estimate is far off
+      raise ValueError(
+        f"the partial descriptions are too big to merge two of them in one request of {model} ({chunk_budget} tokens)"
+      )
+    print(f"merging {len(partial_descriptions)} partial descriptions into {len(groups)}")
+    user_prompts = [merge_prompt(group, note, DESCRIBE_PART_INSTRUCTION) for group in groups]
+    partial_descriptions = list(generate_response.map(
+      [MERGE_SYSTEM_PROMPT] * len(groups), user_prompts, [model] * len(groups), [reply_tokens] * len(groups)
+    ))
+
+  return generate_response.call(
+    MERGE_SYSTEM_PROMPT, merge_prompt(partial_descriptions, note, DESCRIBE_INSTRUCTION), model, reply_tokens
+  )
+
+
+def map_reduce_budget(context_window):
+  """The max_tokens of every map and merge reply, and the tokens of files or descriptions one request may hold."""
+  # the chunk plus the reply fill the window, and a chunk has room for two replies: 3 replies' worth plus overhead
+  reply_tokens = min(CODE2PROMPT_MAX_TOKENS, (context_window - PROMPT_OVERHEAD_TOKENS) // 3)
+  return reply_tokens, context_window - PROMPT_OVERHEAD_TOKENS - reply_tokens
+
+
+def merge_prompt(descriptions, note, instruction):
+  context = "\n\n---\n\n".join(descriptions)
+  return "The descriptions are as follows:\n\n" + context + "\n\n" + note + instruction
+
+
+def truncate_to_tokens(contents, tokens, budget):
+  # a single file that is bigger than a whole chunk gets cut, roughly proportionally to its token count
+  if tokens <= budget:
+    return contents
+  return contents[: len(contents) * budget // tokens] + "\n... (truncated)"
+
+
 @stub.function(
     image=openai_image,
     secret=modal.Secret.from_dotenv(),
-    retries=modal.Retries(
-        max_retries=3,
-        backoff_coefficient=2.0,
-        initial_delay=1.0,
-    ),
+    # retries happen inside the function (see retry.py), so that fatal errors are not retried and Retry-After is honored
     concurrency_limit=5,
-    timeout=120,
+    timeout=300,
 )
-def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, *args):
-    import openai
-
-    # Set up your OpenAI API credentials
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-
+def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, max_tokens=CODE2PROMPT_MAX_TOKENS, *args):
     messages = []
     messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": user_prompt})
@@ -70,12 +139,12 @@ def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, *args):
     params = {
         'model': model,
         "messages": messages,
-        "max_tokens": 2500,
+        "max_tokens": max_tokens,
         "temperature": 0,
     }
 
     # Send the API request
-    response = openai.ChatCompletion.create(**params)
+    response = retry_policy.call(llm_client.create, **params)
 
     # Get the reply from the API response
     reply = response.choices[0]["message"]["content"]
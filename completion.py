@@ -0,0 +1,207 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from cancellation import cancel_registry
+from constants import MAX_CONTINUATIONS
+from continuation import continuation_messages, join_continuation
+from file_writer import run_io
+from hedging import hedger
+from ledger import ledger
+from llm_client import llm_client
+from retry import RetryBudget, is_rate_limited, retry_after, retry_policy
+from scheduler import scheduler
+from streaming import StreamCoalescer
+from token_counter import estimate_tokens
+from tracing import current_span, tracer
+
+
+class CompletionRequest:
+    """
+    The OpenAI requests behind one reply of the ResponseGenerator bot: the request itself, streamed (to `on_delta`,
+    called with the fields of a `StreamDelta`) or not, retried by the retry policy, hedged when it takes unusually
+    long (see hedging.py), and continued when it is cut off by `max_tokens` (see continuation.py). Every request waits
+    for a scheduler slot, is traced and is charged to the run in the ledger, `spent` is what they cost together.
+    """
+
+    def __init__(
+        self,
+        params: dict,
+        run_id: Optional[str] = None,
+        user: Optional[str] = None,
+        stage: Optional[str] = None,
+        on_delta: Optional[Callable[..., Awaitable[Any]]] = None,
+    ) -> None:
+        self.params = params
+        self.model = params["model"]
+        self.run_id = run_id
+        self.user = user
+        self.stage = stage
+        self.on_delta = on_delta
+        self.prompt_tokens = 0
+        self.attempts = 0
+        self.spent = 0.0
+        # part of the reply was streamed already, a retry has to tell the consumer to start over
+        self.streamed = False
+        self.span = current_span()
+
+    async def complete(self, prompt_tokens: int, budget: Optional[RetryBudget] = None) -> str:
+        self.prompt_tokens = prompt_tokens
+        reply, finish_reason = await retry_policy.acall(self.send, budget=budget, on_retry=self._on_retry)
+        # a reply cut off by max_tokens is picked up where it stopped instead of ending up truncated on disk
+        for _ in range(MAX_CONTINUATIONS):
+            if finish_reason != "length":
+                break
+            self.span.add("continuations")
+            more, finish_reason = await retry_policy.acall(self.send, reply, budget=budget, on_retry=self._on_retry)
+            joined = join_continuation(reply, more)
+            if self.on_delta is not None:
+                await self.on_delta(delta=joined[len(reply) :])
+            reply = joined
+        if finish_reason == "length":
+            # TODO send this to the UserProxyBot
+            print(f"the reply is still cut off after {MAX_CONTINUATIONS} continuations")
+        return reply
+
+    async def send(self, partial: Optional[str] = None) -> tuple[str, Optional[str]]:
+        """One request, the continuation of `partial` if given. Returns the reply and its finish reason."""
+        self.attempts += 1
+        # a run that is over its spend cap, cancelled or past its deadline sends no further requests (neither error is
+        # retried)
+        ledger.check(self.run_id)
+        token = cancel_registry.get(self.run_id)
+        if token is not None:
+            token.check()
+        call_timeout = cancel_registry.timeout(self.run_id)
+        params = self.params
+        prompt_tokens = self.prompt_tokens
+        if partial is not None:
+            # a continuation of a reply that got cut off, it is not streamed, the caller passes it on in one go
+            params = dict(self.params, messages=continuation_messages(self.params["messages"], partial))
+            added_messages = params["messages"][len(self.params["messages"]) :]
+            prompt_tokens += sum(estimate_tokens(message["content"]) for message in added_messages)
+        slot_tokens = prompt_tokens + self.params["max_tokens"]
+
+        queued = time.monotonic()
+        # the scheduler decides when the request may go out, based on the model's rate limits
+        async with scheduler.slot(self.model, slot_tokens):
+            with tracer.span(
+                "openai_request",
+                kind="openai",
+                model=self.model,
+                attempt=self.attempts,
+                continuation=partial is not None,
+                queue_wait=time.monotonic() - queued,
+                prompt_tokens=prompt_tokens,
+            ) as request_span:
+                if self.on_delta is not None and partial is None:
+                    reply, finish_reason, hedged = await self._stream(call_timeout, slot_tokens)
+                    usage = None
+                else:
+                    reply, finish_reason, usage, hedged = await self._call(params, call_timeout, slot_tokens)
+                if usage:
+                    request_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+                else:
+                    # streamed replies come without usage
+                    request_tokens, completion_tokens = prompt_tokens, estimate_tokens(reply)
+                request_span.set(
+                    prompt_tokens=request_tokens,
+                    completion_tokens=completion_tokens,
+                    finish_reason=finish_reason,
+                    hedged=hedged,
+                )
+        scheduler.on_success(self.model)
+        await self._charge(request_tokens, completion_tokens, estimated=not usage, hedged=hedged)
+        return reply, finish_reason
+
+    async def _call(
+        self, params: dict, call_timeout: Optional[float], slot_tokens: int
+    ) -> tuple[str, Optional[str], Optional[dict], bool]:
+        async def call() -> Any:
+            return await asyncio.wait_for(llm_client.acreate(**params), call_timeout)
+
+        # Send the API request (and a duplicate of it, if it takes unusually long)
+        response, hedged = await hedger.run(self.model, "reply", call, self._duplicate(call, slot_tokens))
+        # Get the reply from the API response
+        choice = response.choices[0]
+        return choice["message"]["content"], choice.get("finish_reason"), response.get("usage"), hedged
+
+    async def _stream(self, call_timeout: Optional[float], slot_tokens: int) -> tuple[str, Optional[str], bool]:
+        if self.streamed:
+            await self.on_delta(restart=True)
+
+        async def open_stream() -> tuple[list, Any]:
+            return await asyncio.wait_for(self._open_stream(), call_timeout)
+
+        # a stream that takes unusually long to start gets a duplicate, the first one to start is read
+        (head, stream), hedged = await hedger.run(
+            self.model, "first_token", open_stream, self._duplicate(open_stream, slot_tokens), _close_stream
+        )
+
+        coalescer = StreamCoalescer()
+        parts = []
+        finish_reason = None
+        async for chunk in _chunks(head, stream, call_timeout):
+            delta = chunk.choices[0]["delta"].get("content")
+            finish_reason = chunk.choices[0].get("finish_reason") or finish_reason
+            if delta:
+                parts.append(delta)
+                self.streamed = True
+                coalesced = coalescer.add(delta)
+                if coalesced:
+                    await self.on_delta(delta=coalesced)
+        coalesced = coalescer.flush()
+        if coalesced:
+            await self.on_delta(delta=coalesced)
+        return "".join(parts), finish_reason, hedged
+
+    async def _open_stream(self) -> tuple[list, Any]:
+        """The chunks of a streamed reply up to its first token, and the stream the rest of it comes from."""
+        stream = (await llm_client.acreate(**self.params, stream=True)).__aiter__()
+        head = []
+        async for chunk in stream:
+            head.append(chunk)
+            if chunk.choices[0]["delta"].get("content") or chunk.choices[0].get("finish_reason"):
+                break
+        return head, stream
+
+    def _duplicate(self, call: Callable[[], Awaitable[Any]], slot_tokens: int) -> Callable[[], Awaitable[Any]]:
+        async def duplicate() -> Any:
+            # the duplicate of a hedged request is a request of its own as far as the rate limits are concerned
+            async with scheduler.slot(self.model, slot_tokens):
+                return await call()
+
+        return duplicate
+
+    async def _charge(self, prompt_tokens: int, completion_tokens: int, estimated: bool, hedged: bool) -> None:
+        self.spent += await run_io(
+            ledger.record, self.run_id, self.user, self.model, self.stage, prompt_tokens, completion_tokens, estimated
+        )
+        if hedged:
+            # what the other one of the two requests cost is unknown, it is accounted for as if it had finished too
+            self.spent += await run_io(
+                ledger.record, self.run_id, self.user, self.model, "hedge", prompt_tokens, completion_tokens, True
+            )
+
+    def _on_retry(self, exc: BaseException, delay: float) -> None:
+        self.span.add("retries")
+        if is_rate_limited(exc):
+            scheduler.on_rate_limited(self.model, retry_after(exc))
+
+
+async def _chunks(head: list, stream: Any, call_timeout: Optional[float]) -> AsyncIterator:
+    for chunk in head:
+        yield chunk
+    while True:
+        try:
+            # a stream that stalls times out like a request that never answers
+            chunk = await asyncio.wait_for(stream.__anext__(), call_timeout)
+        except StopAsyncIteration:
+            return
+        yield chunk
+
+
+async def _close_stream(opened: tuple[list, Any]) -> None:
+    aclose = getattr(opened[1], "aclose", None)
+    if aclose is not None:
+        await aclose()
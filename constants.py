@@ -1,4 +1,80 @@
 EXTENSION_TO_SKIP = [".png",".jpg",".jpeg",".gif",".bmp",".svg",".ico",".tif",".tiff"]
 DEFAULT_DIR = "generated"
 DEFAULT_MODEL = "gpt-3.5-turbo" # we recommend 'gpt-4' if you have it # gpt3.5 is going to be worse at generating code so we strongly recommend gpt4. i know most people dont have access, we are working on a hosted version 
-DEFAULT_MAX_TOKENS = 2000 # i wonder how to tweak this properly. we dont want it to be max length as it encourages verbosity of code. but too short and code also truncates suddenly.
\ No newline at end of file
+DEFAULT_MAX_TOKENS = 2000 # i wonder how to tweak this properly. we dont want it to be max length as it encourages verbosity of code. but too short and code also truncates suddenly.
+DEFAULT_CACHE_DIR = ".smol_cache"
+CACHE_MAX_BYTES = 200 * 1024 * 1024 # replies are small, this is plenty for many full runs
+CACHE_MAX_AGE = 7 * 24 * 60 * 60 # seconds
+DEFAULT_MAX_IN_FLIGHT = 8 # max concurrent openai requests per process
+HTTP_POOL_SIZE = 8 # keep-alive connections to the openai api per process, requests beyond that wait for one
+# (tokens per minute, requests per minute) - the defaults of a fresh openai account, raise them if your limits are higher
+MODEL_RATE_LIMITS = {
+    "gpt-4": (40_000, 200),
+    "gpt-4-32k": (80_000, 400),
+    "gpt-3.5-turbo": (90_000, 3_500),
+    "gpt-3.5-turbo-16k": (180_000, 3_500),
+    "default": (40_000, 200),
+}
+DEFAULT_CONCURRENCY = 4 # files generated at the same time by main_no_modal.py
+RETRY_MAX_ATTEMPTS = 6 # per request, including the first attempt
+RETRY_BASE_DELAY = 1.0 # seconds, doubled on every attempt (with jitter)
+RETRY_MAX_DELAY = 60.0 # seconds
+RETRY_RUN_BUDGET = 50 # retries shared by all the requests of one run
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4": 8_192,
+    "gpt-4-32k": 32_768,
+    "gpt-3.5-turbo": 4_096,
+    "gpt-3.5-turbo-16k": 16_384,
+    "default": 4_096,
+}
+# dollars per 1000 (prompt, completion) tokens, unknown models are priced like gpt-4 so that spend caps err on the safe
+# side
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "default": (0.03, 0.06),
+}
+QUEUE_MAX_RUNS = 2 # smol_ai runs the discord bot works on at the same time...
+QUEUE_MAX_RUNS_PER_USER = 1 # ...and per user
+QUEUE_MAX_DEPTH = 20 # runs waiting beyond this many are turned away right away
+QUEUE_DEFAULT_RUN_SECONDS = 180.0 # for the ETA until the first run has finished
+MERGER_TTL = 60 * 60 # seconds the discord bot keeps a message in memory...
+MERGER_MAX_PER_CHANNEL = 200 # ...and how many messages per channel at most, older ones are spilled to disk
+MERGER_LARGE_PAYLOAD_CHARS = 16 * 1024 # messages bigger than this go to disk right away and are kept by reference
+MERGER_MAX_UNSPILLABLE = 1000 # messages that can't be pickled kept in memory instead, the oldest beyond are dropped
+MERGER_SPILL_MAX_AGE = 7 * 24 * 60 * 60 # seconds
+# roughly how many tokens a generated file of each type comes to
+FILE_TYPE_TOKENS = {
+    ".json": 200,
+    ".txt": 200,
+    ".md": 400,
+    ".css": 500,
+    ".html": 600,
+    ".js": 1200,
+    ".jsx": 1200,
+    ".ts": 1200,
+    ".tsx": 1200,
+    ".py": 1200,
+    "default": 800,
+}
+BATCH_SMALL_FILE_TOKENS = 600 # files expected to be bigger than this always get a request of their own
+BATCH_MAX_FILES = 6
+MAX_CONTINUATIONS = 3 # requests that pick up a reply cut off by max_tokens where it stopped, per reply
+OUTPUT_HEADROOM = 1.5 # max_tokens of a file over the size files of its type usually come to
+OUTPUT_MIN_TOKENS = 256
+OUTPUT_SIZES_KEPT = 50 # past output sizes per file type that max_tokens is based on
+ROUTE_FAST_MODEL = "gpt-3.5-turbo" # small, simple files are generated with this model rather than the run's
+ROUTE_SIMPLE_TOKENS = 600 # files whose complexity (see routing.py) is above this always get the run's model...
+ROUTE_TOKENS_PER_MENTION = 100 # ...which counts every mention of the file in the shared dependencies this much
+ROUTE_MAX_FAILURE_RATE = 0.2 # file types the fast model fails validation on more often than this go to the run's model
+ROUTE_MIN_SAMPLES = 5 # validation results of a file type needed before its failure rate counts
+ROUTE_QUALITY_WINDOW = 20 # latest validation results per file type and model the failure rate is based on
+HEDGE_BUDGET = 0.1 # share of the requests that may get a hedged duplicate, which is what hedging costs at most
+HEDGE_QUANTILE = 0.9 # a request gets a duplicate once it takes longer than this quantile of recent requests
+HEDGE_MIN_SAMPLES = 10 # recent latencies (per model) needed before anything is hedged
+HEDGE_MIN_DELAY = 1.0 # seconds, never hedge sooner than this
+HEDGE_WINDOW = 200 # recent latencies per model the quantile is taken from
+RUN_DEADLINE = 30 * 60 # seconds a run of main.py may take before it is cancelled
+CALL_TIMEOUT = 5 * 60 # seconds a single OpenAI request may take (streamed: until its first token, and between tokens)
@@ -0,0 +1,116 @@
+import json
+import math
+import os
+import tempfile
+import threading
+
+from batching import expected_tokens
+from constants import DEFAULT_CACHE_DIR, MODEL_CONTEXT_WINDOWS, OUTPUT_HEADROOM, OUTPUT_MIN_TOKENS, OUTPUT_SIZES_KEPT
+
+CONTINUE_PROMPT = """Your reply was cut off. Continue exactly where you stopped, starting with the very next \
+character. Do not repeat anything you already wrote, do not add any explanation and do not include code fences."""
+# the shortest tail of the partial reply a continuation has to repeat for the repetition to be cut off, anywhere and
+# from the start of a line
+MIN_OVERLAP_CHARS = 20
+MIN_LINE_OVERLAP_CHARS = 4
+
+
+def continuation_messages(messages: list[dict], partial: str) -> list[dict]:
+    """The messages of the request that picks up a reply that was cut off by `max_tokens` where it stopped."""
+    return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def join_continuation(partial: str, more: str) -> str:
+    """
+    Appends a continuation to the partial reply. Models tend to start a continuation by repeating the last line they
+    wrote, so if the continuation starts with the tail of the partial reply, that part is dropped.
+    """
+    if more.startswith("```"):
+        # despite being told not to, the continuation came in a code fence
+        more = more.split("\n", 1)[1] if "\n" in more else ""
+        if more.rstrip().endswith("```"):
+            more = more.rstrip()[:-3]
+    tail = partial[-2000:]
+    for start in range(len(tail)):
+        overlap = tail[start:]
+        at_line_start = start > 0 and tail[start - 1] == "\n"
+        long_enough = len(overlap) >= MIN_OVERLAP_CHARS
+        if at_line_start and len(overlap.strip()) >= MIN_LINE_OVERLAP_CHARS:
+            long_enough = True
+        if long_enough and more.startswith(overlap):
+            return partial + more[len(overlap) :]
+    return partial + more
+
+
+class OutputBudget:
+    """
+    Picks `max_tokens` for every generated file from its type and the sizes of the files of that type generated
+    before, so that big files fit into one reply and small ones don't reserve (and get charged against the rate limit
+    for) a budget they never use. The sizes are kept in the cache directory across runs.
+
+    Files that are cut off anyway are continued (see `continuation_messages`) rather than lost.
+
+    `max_tokens` is part of the response cache key, so a run takes its budgets from a `snapshot` made when it starts
+    rather than from a history that changes with every file, and budgets are rounded up to a power of two, so that
+    the next run only asks for a different one once the sizes of a file type have changed a lot.
+    """
+
+    def __init__(self, path: str = None) -> None:
+        self.path = path
+        self.sizes: dict[str, list[int]] = {}
+        self._lock = threading.Lock()
+        if path is not None:
+            try:
+                with open(path, "r", encoding="utf-8") as file:
+                    self.sizes = json.load(file)["sizes"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+    @classmethod
+    def from_env(cls) -> "OutputBudget":
+        if os.environ.get("SMOL_CACHE", "on").lower() == "off":
+            # nothing is persisted when caching is off, e.g. in the benchmarks, every run starts cold
+            return cls()
+        return cls(os.path.join(os.environ.get("SMOL_CACHE_DIR", DEFAULT_CACHE_DIR), "output_sizes.json"))
+
+    @staticmethod
+    def _file_type(filename: str) -> str:
+        return os.path.splitext(filename)[1].lower() or filename
+
+    def max_tokens(self, filename: str, model: str) -> int:
+        with self._lock:
+            sizes = sorted(self.sizes.get(self._file_type(filename), []))
+        # the size most files of this type came to (p90), or the rough size of the type before there is any history
+        expected = sizes[int(len(sizes) * 0.9)] if sizes else expected_tokens(filename)
+        # the prompt needs room in the context window as well
+        ceiling = MODEL_CONTEXT_WINDOWS.get(model, MODEL_CONTEXT_WINDOWS["default"]) // 2
+        bucket = 1 << max(0, math.ceil(math.log2(max(1, expected * OUTPUT_HEADROOM))))
+        return max(OUTPUT_MIN_TOKENS, min(bucket, ceiling))
+
+    def snapshot(self) -> "OutputBudget":
+        """The budgets as they are now, for one run, which records its sizes here rather than in the snapshot."""
+        snapshot = OutputBudget()
+        with self._lock:
+            snapshot.sizes = {file_type: list(type_sizes) for file_type, type_sizes in self.sizes.items()}
+        return snapshot
+
+    def record(self, filename: str, tokens: int) -> None:
+        with self._lock:
+            sizes = self.sizes.setdefault(self._file_type(filename), [])
+            sizes.append(tokens)
+            del sizes[:-OUTPUT_SIZES_KEPT]
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        with self._lock:
+            sizes = {file_type: list(type_sizes) for file_type, type_sizes in self.sizes.items()}
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump({"sizes": sizes}, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+output_budget = OutputBudget.from_env()
@@ -1,33 +1,20 @@
 import modal
-import os
-from constants import DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, EXTENSION_TO_SKIP
+from constants import DEFAULT_DIR
+from llm_client import llm_client
+from retry import retry_policy
+from scan_index import ScanIndex
+from token_counter import COUNT_TOKENS
 
 stub = modal.Stub("smol-debugger-v1")
 openai_image = modal.Image.debian_slim().pip_install("openai")
 
 
-
-def read_file(filename):
-    with open(filename, 'r') as file:
-        return file.read()
-
-def walk_directory(directory):
-    code_contents = {}
-    for dirpath, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if not any(filename.endswith(ext) for ext in EXTENSION_TO_SKIP):
-                try:
-                    relative_filepath = os.path.relpath(os.path.join(dirpath, filename), directory)
-                    code_contents[relative_filepath] = read_file(os.path.join(dirpath, filename))
-                except Exception as e:
-                    code_contents[relative_filepath] = f"Error reading file {filename}: {str(e)}"
-    return code_contents
-
-
-
 @stub.local_entrypoint()
 def main(prompt, directory=DEFAULT_DIR, model="gpt-3.5-turbo"):
-  code_contents = walk_directory(directory)
+  # only the files that changed since the last run are read (and their tokens counted) again
+  index = ScanIndex(directory)
+  code_contents = index.scan(model if COUNT_TOKENS else None)
+  print(index.changes.summary())
 
   # Now, `code_contents` is a dictionary that contains the content of all your non-image files
   # You can send this to OpenAI's text-davinci-003 for help
@@ -36,6 +23,9 @@ def main(prompt, directory=DEFAULT_DIR, model="gpt-3.5-turbo"):
   system = "You are an AI debugger who is trying to debug a program for a user based on their file system. The user has provided you with the following files and their contents, finally folllowed by the error message or issue they are facing."
   prompt = "My files are as follows: " + context + "\n\n" + "My issue is as follows: " + prompt
   prompt += "\n\nGive me ideas for what could be wrong and what fixes to do in which files."
+  if COUNT_TOKENS:
+    file_tokens = sum(index.tokens(model).values())
+    print("\033[37m" + str(file_tokens) + " tokens\033[0m in " + str(len(code_contents)) + " files")
   res = generate_response.call(system, prompt, model)
   # print res in teal
   print("\033[96m" + res + "\033[0m")
@@ -44,20 +34,11 @@ def main(prompt, directory=DEFAULT_DIR, model="gpt-3.5-turbo"):
 @stub.function(
     image=openai_image,
     secret=modal.Secret.from_dotenv(),
-    retries=modal.Retries(
-        max_retries=3,
-        backoff_coefficient=2.0,
-        initial_delay=1.0,
-    ),
+    # retries happen inside the function (see retry.py), so that fatal errors are not retried and Retry-After is honored
     concurrency_limit=5,
-    timeout=120,
+    timeout=300,
 )
 def generate_response(system_prompt, user_prompt, model="gpt-3.5-turbo", *args):
-    import openai
-
-    # Set up your OpenAI API credentials
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-
     messages = []
     messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": user_prompt})
@@ -76,7 +57,7 @@ def generate_response(system_prompt, user_prompt, model="gpt-3.5-turbo", *args):
     }
 
     # Send the API request
-    response = openai.ChatCompletion.create(**params)
+    response = retry_policy.call(llm_client.create, **params)
 
     # Get the reply from the API response
     reply = response.choices[0]["message"]["content"]
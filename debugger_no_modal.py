@@ -1,48 +1,22 @@
-import sys
-import os
-from time import sleep
-from constants import DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, EXTENSION_TO_SKIP
+from constants import DEFAULT_DIR, DEFAULT_MODEL
+from ledger import ledger
+from llm_client import llm_client
+from retry import RetryBudget, retry_policy
+from scan_index import ScanIndex
+from token_counter import COUNT_TOKENS
 import argparse
-def read_file(filename):
-    with open(filename, "r") as file:
-        return file.read()
-
-
-def walk_directory(directory):
-    image_extensions = [
-        ".png",
-        ".jpg",
-        ".jpeg",
-        ".gif",
-        ".bmp",
-        ".svg",
-        ".ico",
-        ".tif",
-        ".tiff",
-    ]
-    code_contents = {}
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if not any(file.endswith(ext) for ext in image_extensions):
-                try:
-                    relative_filepath = os.path.relpath(
-                        os.path.join(root, file), directory
-                    )
-                    code_contents[relative_filepath] = read_file(
-                        os.path.join(root, file)
-                    )
-                except Exception as e:
-                    code_contents[
-                        relative_filepath
-                    ] = f"Error reading file {file}: {str(e)}"
-    return code_contents
+import getpass
+from uuid import uuid4
 
 
 def main(args):
     prompt=args.prompt
     directory= args.directory
     model=args.model
-    code_contents = walk_directory(directory)
+    # only the files that changed since the last run are read (and their tokens counted) again
+    index = ScanIndex(directory)
+    code_contents = index.scan(model if COUNT_TOKENS else None)
+    print(index.changes.summary())
 
     # Now, `code_contents` is a dictionary that contains the content of all your non-image files
     # You can send this to OpenAI's text-davinci-003 for help
@@ -61,17 +35,22 @@ def main(args):
     prompt += (
         "\n\nGive me ideas for what could be wrong and what fixes to do in which files."
     )
+    if COUNT_TOKENS:
+        file_tokens = sum(index.tokens(model).values())
+        print("\033[37m" + str(file_tokens) + " tokens\033[0m in " + str(len(code_contents)) + " files")
     res = generate_response(system, prompt, model)
     # print res in teal
     print("\033[96m" + res + "\033[0m")
+    print(ledger.run_summary(run_id))
 
 
-def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, *args):
-    import openai
+# retries shared by all the requests of this run
+run_retry_budget = RetryBudget()
+# the ledger accounts this run's spend under this id, and under the user running it
+run_id = uuid4().hex
 
-    # Set up your OpenAI API credentials
-    openai.api_key = os.environ["OPENAI_API_KEY"]
 
+def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, *args):
     messages = []
     messages.append({"role": "system", "content": system_prompt})
     messages.append({"role": "user", "content": user_prompt})
@@ -89,17 +68,12 @@ def generate_response(system_prompt, user_prompt, model=DEFAULT_MODEL, *args):
         "temperature": 0,
     }
 
-    # Send the API request
-    keep_trying = True
-    while keep_trying:
-        try:
-            response = openai.ChatCompletion.create(**params)
-            keep_trying = False
-        except Exception as e:
-            # e.g. when the API is too busy, we don't want to fail everything
-            print("Failed to generate response. Error: ", e)
-            sleep(30)
-            print("Retrying...")
+    # Send the API request (e.g. when the API is too busy, we don't want to fail everything, so transient errors are
+    # retried)
+    ledger.check(run_id)
+    response = retry_policy.call(llm_client.create, **params, budget=run_retry_budget)
+    usage = response["usage"]
+    ledger.record(run_id, getpass.getuser(), model, "debug", usage["prompt_tokens"], usage["completion_tokens"])
 
     # Get the reply from the API response
     reply = response.choices[0]["message"]["content"]
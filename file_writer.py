@@ -0,0 +1,265 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+WRITE_BUFFER_SIZE = 8192
+TMP_PREFIX = ".smol_tmp_" # our own bookkeeping files all start with ".smol", so nothing else picks them up
+# staging trees of another process that is still alive are swept once they are this old anyway (its pid was reused)
+STAGING_MAX_AGE = 24 * 60 * 60 # seconds
+
+# mkstemp creates files readable by the owner only, generated files should get the usual permissions instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# all the blocking file system work of the async pipeline happens here, never on the event loop
+io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="file_writer")
+
+
+async def run_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, fn, *args)
+
+
+# runs that write to the same output directory take turns, see `OutputTree.begin`
+_directory_locks: dict[str, asyncio.Lock] = {}
+
+
+def directory_lock(directory: str) -> asyncio.Lock:
+    return _directory_locks.setdefault(os.path.abspath(directory), asyncio.Lock())
+
+
+def atomic_write(file_path: str, content: str) -> None:
+    """Write through a temp file in the same directory and rename it into place, readers never see half a file."""
+    fd, tmp_path = _mkstemp(file_path)
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+
+
+class OutputTree:
+    """
+    The output directory of a run. With `staged=True` every write goes into a staging copy of the directory (made of
+    hard links, so it is cheap) and `commit` swaps the whole tree in at the end of the run, so nobody ever sees a mix
+    of old and new files. Without staging (single file regeneration) files are still written atomically one by one.
+
+    Runs that write to the same directory take turns: `begin` waits for the runs before it to `commit` or `abort`.
+    """
+
+    def __init__(self, directory: str, staged: bool = True) -> None:
+        self.directory = directory
+        self.staged = staged
+        parent, name = os.path.split(os.path.abspath(directory))
+        self._staging_prefix = os.path.join(parent, f".{name}.staging-")
+        self._old_prefix = os.path.join(parent, f".{name}.old-")
+        # the pid in the name tells the trees of runs that are still going from the leftovers of ones that crashed
+        self.root = f"{self._staging_prefix}{os.getpid()}-{uuid.uuid4().hex}" if staged else directory
+        self._created_dirs: set[str] = set()
+        self._lock = directory_lock(directory)
+        self._locked = False
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.root, filename)
+
+    async def begin(self) -> None:
+        await self._lock.acquire()
+        self._locked = True
+        try:
+            await run_io(self._begin)
+        except BaseException:
+            await self.abort()
+            raise
+
+    def _release(self) -> None:
+        if self._locked:
+            self._locked = False
+            self._lock.release()
+
+    def _begin(self) -> None:
+        if not self.staged:
+            os.makedirs(self.root, exist_ok=True)
+            return
+        parent = os.path.dirname(self._staging_prefix)
+        os.makedirs(parent, exist_ok=True)
+        for entry in os.listdir(parent):
+            leftover = os.path.join(parent, entry)
+            if _is_leftover(leftover, (self._staging_prefix, self._old_prefix)):
+                shutil.rmtree(leftover, ignore_errors=True)
+
+        if os.path.isdir(self.directory):
+            try:
+                shutil.copytree(self.directory, self.root, symlinks=True, copy_function=os.link)
+            except (OSError, shutil.Error):
+                # no hard links on this file system
+                shutil.rmtree(self.root, ignore_errors=True)
+                shutil.copytree(self.directory, self.root, symlinks=True)
+        else:
+            os.makedirs(self.root)
+
+    async def prepare_dirs(self, filenames: Iterable[str]) -> None:
+        """Create the directories of all the given files with a single trip to the I/O executor."""
+        dirs = {os.path.dirname(self.path(filename)) for filename in filenames} - self._created_dirs
+        if dirs:
+            await run_io(_makedirs, dirs)
+            self._created_dirs |= dirs
+
+    async def write(self, filename: str, content: str) -> None:
+        file_path = self.path(filename)
+        # Check if the filename is actually a directory
+        if os.path.isdir(file_path):
+            raise IsADirectoryError(f"{filename} is a directory, not a file.")
+        await self.prepare_dirs([filename])
+        await run_io(atomic_write, file_path, content)
+
+    async def run(self, fn, *args):
+        """Run some other blocking file system work (e.g. removing stale files) against the tree."""
+        return await run_io(fn, *args)
+
+    async def commit(self) -> None:
+        if not self._locked:
+            # `begin` never got its turn
+            return
+        try:
+            if self.staged:
+                await run_io(self._commit)
+        finally:
+            self._release()
+
+    def _commit(self) -> None:
+        old = None
+        if os.path.exists(self.directory):
+            old = f"{self._old_prefix}{os.getpid()}-{uuid.uuid4().hex}"
+            os.rename(self.directory, old)
+        os.rename(self.root, self.directory)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+
+    async def abort(self) -> None:
+        if not self._locked:
+            return
+        try:
+            if self.staged:
+                await run_io(shutil.rmtree, self.root, True)
+        finally:
+            self._release()
+
+
+class StreamingFileWriter:
+    """
+    Appends streamed text to a temp file next to the target, going to the disk (on the I/O executor) once per
+    `buffer_size` characters rather than once per delta. `close` renames the temp file into place.
+    """
+
+    def __init__(self, file_path: str, buffer_size: int = WRITE_BUFFER_SIZE) -> None:
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.chars_written = 0
+        self._buffer: list[str] = []
+        self._buffered = 0
+        self._file = None
+        self._tmp_path: Optional[str] = None
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+        fd, self._tmp_path = _mkstemp(self.file_path)
+        self._file = os.fdopen(fd, "w")
+
+    def _write(self, text: str) -> None:
+        if self._file is None:
+            self._open()
+        self._file.write(text)
+        self._file.flush()
+
+    async def write(self, text: str) -> None:
+        self._buffer.append(text)
+        self._buffered += len(text)
+        self.chars_written += len(text)
+        if self._buffered >= self.buffer_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        await run_io(self._write, text)
+
+    async def reset(self) -> None:
+        """Throw away everything written so far (the stream is being retried from the start)."""
+        self._buffer = []
+        self._buffered = 0
+        self.chars_written = 0
+        if self._file is not None:
+            await run_io(self._truncate)
+
+    def _truncate(self) -> None:
+        self._file.seek(0)
+        self._file.truncate()
+
+    async def close(self) -> None:
+        await self.flush()
+        await run_io(self._close)
+
+    def _close(self) -> None:
+        self._file.close()
+        os.replace(self._tmp_path, self.file_path)
+
+    async def abort(self) -> None:
+        if self._file is not None:
+            await run_io(self._abort)
+
+    def _abort(self) -> None:
+        self._file.close()
+        _remove_quietly(self._tmp_path)
+
+
+def _mkstemp(file_path: str) -> tuple[int, str]:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=TMP_PREFIX)
+    os.fchmod(fd, 0o666 & ~UMASK)
+    return fd, tmp_path
+
+
+def _makedirs(dirs: Iterable[str]) -> None:
+    for dir_path in dirs:
+        os.makedirs(dir_path, exist_ok=True)
+
+
+def _is_leftover(path: str, prefixes: tuple[str, ...]) -> bool:
+    """
+    Whether the path is a staging (or old) tree of a run that crashed before it could commit or abort. Trees of this
+    process are, as the runs of a directory take turns, trees of other processes only once their process is gone.
+    """
+    prefix = next((prefix for prefix in prefixes if path.startswith(prefix)), None)
+    if prefix is None:
+        return False
+    try:
+        pid = int(path[len(prefix) :].split("-", 1)[0])
+    except ValueError:
+        # no pid in the name
+        return True
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # alive, but someone else's
+        pass
+    try:
+        return time.time() - os.path.getmtime(path) > STAGING_MAX_AGE
+    except OSError:
+        return False
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+from constants import HEDGE_BUDGET, HEDGE_MIN_DELAY, HEDGE_MIN_SAMPLES, HEDGE_QUANTILE, HEDGE_WINDOW
+
+T = TypeVar("T")
+
+
+class Hedger:
+    """
+    Hedged requests: when a request has not come back (or, streaming, not produced its first token) within the p90
+    of what that has recently taken for its model, a duplicate goes out and whichever succeeds first wins, the other
+    one is cancelled. One slow request then no longer sets the latency of a whole run.
+
+    Duplicates cost money, so at most `budget` (a share) of all requests get one, and there are none before
+    `min_samples` latencies are known to derive the threshold from.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        budget: float = HEDGE_BUDGET,
+        quantile: float = HEDGE_QUANTILE,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        min_delay: float = HEDGE_MIN_DELAY,
+    ) -> None:
+        self.enabled = enabled
+        self.budget = budget
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+        self.requests = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.saved = 0.0
+
+        # (model, kind) -> the latest latencies, kind is "reply" or "first_token"
+        self._latencies: dict[tuple[str, str], deque] = defaultdict(lambda: deque(maxlen=HEDGE_WINDOW))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "Hedger":
+        return cls(
+            enabled=os.environ.get("SMOL_HEDGE", "0") == "1",
+            budget=float(os.environ.get("SMOL_HEDGE_BUDGET", HEDGE_BUDGET)),
+        )
+
+    def threshold(self, model: str, kind: str) -> Optional[float]:
+        """How long a request waits for before it gets a duplicate, None until enough latencies are known."""
+        with self._lock:
+            latencies = sorted(self._latencies[(model, kind)])
+        if len(latencies) < self.min_samples:
+            return None
+        return max(self.min_delay, latencies[min(len(latencies) - 1, int(len(latencies) * self.quantile))])
+
+    def observe(self, model: str, kind: str, seconds: float) -> None:
+        with self._lock:
+            self._latencies[(model, kind)].append(seconds)
+
+    def _try_spend(self) -> bool:
+        with self._lock:
+            if self.hedged >= self.budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def _estimate_saved(self, model: str, kind: str, elapsed: float) -> float:
+        # the original would have taken as long as the requests that took longer than it already had, on average
+        with self._lock:
+            slower = [latency for latency in self._latencies[(model, kind)] if latency > elapsed]
+        return sum(slower) / len(slower) - elapsed if slower else 0.0
+
+    async def run(
+        self,
+        model: str,
+        kind: str,
+        call: Callable[[], Awaitable[T]],
+        hedge: Optional[Callable[[], Awaitable[T]]] = None,
+        discard: Optional[Callable[[T], Awaitable[Any]]] = None,
+    ) -> tuple[T, bool]:
+        """
+        Awaits `call()`, and `hedge()` (a duplicate of it, `call` itself by default) as well once it takes longer than
+        the threshold. Returns the first result and whether a duplicate went out. `discard` cleans up the result of the
+        loser if both finished at once, e.g. closes a stream.
+        """
+        with self._lock:
+            self.requests += 1
+        started = time.monotonic()
+        threshold = self.threshold(model, kind) if self.enabled else None
+        original = asyncio.ensure_future(call())
+        if threshold is None:
+            result = await original
+            self.observe(model, kind, time.monotonic() - started)
+            return result, False
+
+        try:
+            await asyncio.wait_for(asyncio.shield(original), timeout=threshold)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            original.cancel()
+            raise
+        if original.done() or not self._try_spend():
+            result = await original
+            self.observe(model, kind, time.monotonic() - started)
+            return result, False
+
+        hedge_started = time.monotonic()
+        duplicate = asyncio.ensure_future((hedge or call)())
+        pending = {original, duplicate}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded or not pending:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        if not succeeded:
+            # both failed, the error of the original is what a request without a hedge would have raised
+            raise original.exception()
+
+        winner = original if original in succeeded else duplicate
+        for loser in succeeded:
+            if loser is not winner and discard is not None:
+                await discard(loser.result())
+        now = time.monotonic()
+        if winner is duplicate:
+            saved = self._estimate_saved(model, kind, now - started)
+            with self._lock:
+                self.hedges_won += 1
+                self.saved += saved
+            # how long the original would have taken is unknown, the duplicate's own latency is a sample all the same
+            self.observe(model, kind, now - hedge_started)
+        else:
+            self.observe(model, kind, now - started)
+        return winner.result(), True
+
+    def stats(self) -> str:
+        if not self.enabled:
+            return "hedging: off"
+        rate = self.hedged / self.requests if self.requests else 0.0
+        return (
+            f"hedging: {self.hedged} of {self.requests} requests hedged ({rate:.0%}, budget {self.budget:.0%}), "
+            f"{self.hedges_won} won by the hedge, ~{self.saved:.1f}s saved"
+        )
+
+
+hedger = Hedger.from_env()
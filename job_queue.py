@@ -0,0 +1,150 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Optional
+
+from constants import QUEUE_DEFAULT_RUN_SECONDS, QUEUE_MAX_DEPTH, QUEUE_MAX_RUNS, QUEUE_MAX_RUNS_PER_USER
+
+RUN_SECONDS_SMOOTHING = 0.3 # weight of the latest run in the moving average behind the ETA
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user: str) -> None:
+        self.user = user
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        # the user cancelled it before it started
+        self.cancelled = False
+        # set whenever the job starts or moves up in the queue
+        self.changed = asyncio.Event()
+
+    async def wait_for_change(self) -> None:
+        await self.changed.wait()
+        self.changed.clear()
+
+
+class JobQueue:
+    """
+    Admission control for the runs of the discord bot. At most `max_runs` runs happen at once and at most
+    `max_runs_per_user` of them belong to the same user; the rest wait, and the users take turns (round robin): the
+    next run to start is one of the user whose last run started longest ago, so one user queueing many runs does not
+    hold up everyone else. A queue longer than `max_depth` turns new runs away.
+    """
+
+    def __init__(
+        self,
+        max_runs: int = QUEUE_MAX_RUNS,
+        max_runs_per_user: int = QUEUE_MAX_RUNS_PER_USER,
+        max_depth: int = QUEUE_MAX_DEPTH,
+    ) -> None:
+        self.max_runs = max_runs
+        self.max_runs_per_user = max_runs_per_user
+        self.max_depth = max_depth
+        # users with waiting jobs, in the order their first waiting job was submitted
+        self._waiting: dict[str, deque[Job]] = {}
+        self._running: dict[str, int] = {}
+        # when the users' last jobs started, in turns, users whose jobs never started go first
+        self._last_turn: dict[str, int] = {}
+        self._turns = 0
+        self._run_seconds = QUEUE_DEFAULT_RUN_SECONDS
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        return cls(
+            max_runs=int(os.environ.get("SMOL_MAX_RUNS", QUEUE_MAX_RUNS)),
+            max_runs_per_user=int(os.environ.get("SMOL_MAX_RUNS_PER_USER", QUEUE_MAX_RUNS_PER_USER)),
+            max_depth=int(os.environ.get("SMOL_MAX_QUEUE", QUEUE_MAX_DEPTH)),
+        )
+
+    @property
+    def depth(self) -> int:
+        return sum(len(jobs) for jobs in self._waiting.values())
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def submit(self, user: str) -> Job:
+        """Queues a run for the user (it may start right away), raises `QueueFull` if the queue is too long."""
+        if self.depth >= self.max_depth:
+            raise QueueFull(f"the queue is full ({self.depth} runs waiting), please try again later")
+        job = Job(user)
+        self._waiting.setdefault(user, deque()).append(job)
+        self._dispatch()
+        return job
+
+    def done(self, job: Job) -> None:
+        """Called when the job's run is over, or when it is given up on while still waiting."""
+        if job.started is None:
+            jobs = self._waiting.get(job.user)
+            if jobs is not None and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    del self._waiting[job.user]
+        else:
+            self._running[job.user] -= 1
+            if not self._running[job.user]:
+                del self._running[job.user]
+            run_seconds = time.monotonic() - job.started
+            self._run_seconds += RUN_SECONDS_SMOOTHING * (run_seconds - self._run_seconds)
+        self._dispatch()
+
+    def cancel_waiting(self, user: str) -> int:
+        """Takes the user's waiting jobs out of the queue, returns how many there were."""
+        jobs = self._waiting.pop(user, deque())
+        for job in jobs:
+            job.cancelled = True
+            job.changed.set()
+        self._dispatch()
+        return len(jobs)
+
+    def _turn_order(self) -> list[str]:
+        """The users with waiting jobs, the one whose turn it is next first."""
+        # sorted() is stable, users with the same turn (none yet) stay in the order they queued in
+        return sorted(self._waiting, key=lambda user: self._last_turn.get(user, -1))
+
+    def _dispatch(self) -> None:
+        while self.running < self.max_runs:
+            user = next(
+                (user for user in self._turn_order() if self._running.get(user, 0) < self.max_runs_per_user), None
+            )
+            if user is None:
+                break
+            jobs = self._waiting[user]
+            job = jobs.popleft()
+            if not jobs:
+                del self._waiting[user]
+            # back of the line for the user's next job, whether it is waiting already or submitted later on
+            self._last_turn[user] = self._turns
+            self._turns += 1
+            job.started = time.monotonic()
+            self._running[user] = self._running.get(user, 0) + 1
+            job.changed.set()
+        # positions may have changed for everyone still waiting
+        for jobs in self._waiting.values():
+            for job in jobs:
+                job.changed.set()
+
+    def position(self, job: Job) -> int:
+        """1-based position of a waiting job in the order the round robin will start the waiting jobs in."""
+        order = []
+        queues = [list(self._waiting[user]) for user in self._turn_order()]
+        for turn in range(max((len(jobs) for jobs in queues), default=0)):
+            order.extend(jobs[turn] for jobs in queues if turn < len(jobs))
+        return order.index(job) + 1
+
+    def eta(self, job: Job) -> float:
+        """Rough seconds until the job starts: a wave of runs has to finish for every `max_runs` jobs ahead of it."""
+        return math.ceil(self.position(job) / self.max_runs) * self._run_seconds
+
+    def stats(self) -> str:
+        return f"queue: {self.running} running, {self.depth} waiting, ~{self._run_seconds:.0f}s per run"
+
+
+job_queue = JobQueue.from_env()
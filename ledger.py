@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from constants import DEFAULT_CACHE_DIR, MODEL_PRICES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    run_id TEXT,
+    user TEXT,
+    model TEXT NOT NULL,
+    stage TEXT,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    -- streamed replies come without usage, their token counts are our own
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_run_id ON usage (run_id);
+CREATE INDEX IF NOT EXISTS usage_user ON usage (user, timestamp);
+"""
+
+
+class SpendCapExceeded(Exception):
+    def __init__(self, run_id: str, spent: float, cap: float) -> None:
+        super().__init__(f"run {run_id} spent ${spent:.4f}, which is over its cap of ${cap:.4f}")
+        self.run_id = run_id
+        self.spent = spent
+        self.cap = cap
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, MODEL_PRICES["default"])
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class Ledger:
+    """
+    Records the tokens and the cost of every OpenAI call in a SQLite file, by run, user, model and stage. Spend per run
+    is also kept in memory, so that `check` (called before every request) is cheap enough to enforce a per-run cap.
+    """
+
+    def __init__(self, path: str, spend_cap: Optional[float] = None) -> None:
+        self.path = path
+        self.spend_cap = spend_cap
+        # opened on first use, not when the module is imported
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._run_spend: dict[str, float] = {}
+
+    @classmethod
+    def from_env(cls) -> "Ledger":
+        spend_cap = os.environ.get("SMOL_RUN_SPEND_CAP")
+        return cls(
+            path=os.environ.get("SMOL_LEDGER", os.path.join(DEFAULT_CACHE_DIR, "ledger.sqlite")),
+            spend_cap=float(spend_cap) if spend_cap else None,
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._connection.executescript(SCHEMA)
+        return self._connection
+
+    def record(
+        self,
+        run_id: Optional[str],
+        user: Optional[str],
+        model: str,
+        stage: Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+        estimated: bool = False,
+    ) -> float:
+        """Returns the cost of the call."""
+        call_cost = cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO usage (timestamp, run_id, user, model, stage, prompt_tokens, completion_tokens, cost, "
+                "estimated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), run_id, user, model, stage, prompt_tokens, completion_tokens, call_cost, int(estimated)),
+            )
+            if run_id is not None:
+                self._run_spend[run_id] = self._run_spend.get(run_id, 0.0) + call_cost
+        return call_cost
+
+    def run_spend(self, run_id: str) -> float:
+        return self._run_spend.get(run_id, 0.0)
+
+    def check(self, run_id: Optional[str]) -> None:
+        """Raises `SpendCapExceeded` once the run has spent its cap, so that no further requests go out for it."""
+        if self.spend_cap is None or run_id is None:
+            return
+        spent = self.run_spend(run_id)
+        if spent >= self.spend_cap:
+            raise SpendCapExceeded(run_id, spent, self.spend_cap)
+
+    def finish_run(self, run_id: str) -> None:
+        self._run_spend.pop(run_id, None)
+
+    def run_summary(self, run_id: str) -> str:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT stage, model, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), MAX(estimated) "
+                "FROM usage WHERE run_id = ? GROUP BY stage, model ORDER BY SUM(cost) DESC",
+                (run_id,),
+            ).fetchall()
+        if not rows:
+            return "spend: no OpenAI calls"
+        total = sum(row[5] for row in rows)
+        lines = [f"spend: ${total:.4f}"]
+        for stage, model, calls, prompt_tokens, completion_tokens, stage_cost, estimated in rows:
+            lines.append(
+                f"  {stage or 'other'} ({model}): {calls} calls, {prompt_tokens} prompt + {completion_tokens} "
+                f"completion tokens{' (estimated)' if estimated else ''}, ${stage_cost:.4f}"
+            )
+        return "\n".join(lines)
+
+    def user_spend(self, user: str, since: float = 0.0) -> float:
+        with self._lock:
+            (spend,) = self._connect().execute(
+                "SELECT COALESCE(SUM(cost), 0) FROM usage WHERE user = ? AND timestamp >= ?", (user, since)
+            ).fetchone()
+        return spend
+
+
+ledger = Ledger.from_env()
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import threading
+from typing import Any, Optional
+
+from constants import HTTP_POOL_SIZE
+
+
+class LLMClient:
+    """
+    The one way every entry point talks to the OpenAI API. It holds a process-wide pool of keep-alive connections, a
+    `requests.Session` for the sync API and an `aiohttp.ClientSession` (per event loop) for the async one, and hands
+    them to the openai library, which otherwise opens a new session for every async request and one per thread for
+    sync ones. A fan-out of 50 files then reuses at most `pool_size` connections instead of opening 50.
+
+    The openai library (0.x) talks HTTP/1.1 through requests and aiohttp, neither of which can do HTTP/2, so pooled
+    keep-alive connections is as good as it gets here.
+    """
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE) -> None:
+        self.pool_size = pool_size
+        # the module requests go through, e.g. promptlayer.openai (see `use`), the openai module itself by default
+        self._api = None
+        self._session = None
+        self._aiohttp_sessions: dict[asyncio.AbstractEventLoop, Any] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "LLMClient":
+        return cls(pool_size=int(os.environ.get("SMOL_HTTP_POOL_SIZE", HTTP_POOL_SIZE)))
+
+    def use(self, api) -> None:
+        """Send requests through a module that wraps openai, like promptlayer.openai, rather than openai itself."""
+        self._api = api
+
+    def _openai(self):
+        with self._lock:
+            if self._session is None:
+                # imported on first use, so that importing this module stays cheap (and works where openai isn't
+                # installed, e.g. on the local side of the modal apps)
+                import openai
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                openai.api_key = os.environ["OPENAI_API_KEY"]
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                openai.requestssession = session
+                self._session = session
+                if self._api is None:
+                    self._api = openai
+        return self._api
+
+    def create(self, **params: Any) -> Any:
+        return self._openai().ChatCompletion.create(**params)
+
+    async def acreate(self, **params: Any) -> Any:
+        api = self._openai()
+        import openai
+
+        # openai keeps the session in a context variable, so it is set for the task that makes the request
+        openai.aiosession.set(self._aiohttp_session())
+        return await api.ChatCompletion.acreate(**params)
+
+    def _aiohttp_session(self):
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        session = self._aiohttp_sessions.get(loop)
+        if session is None or session.closed:
+            # sessions are bound to their event loop, and benchmarks and tests run several loops one after the other
+            for other_loop in [other_loop for other_loop in self._aiohttp_sessions if other_loop.is_closed()]:
+                del self._aiohttp_sessions[other_loop]
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            session = self._aiohttp_sessions[loop] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    async def aclose(self) -> None:
+        session: Optional[Any] = self._aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+llm_client = LLMClient.from_env()
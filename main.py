@@ -1,32 +1,62 @@
-import ast
+import argparse
 import asyncio
 import os
+import time
 import traceback
+from typing import Optional
+from uuid import uuid4
 
-import discord
-import promptlayer
-import tiktoken
-from botmerger import InMemoryBotMerger, SingleTurnContext
-from botmerger.experimental.inquiry_bot import create_inquiry_bot
-from botmerger.ext.discord_integration import attach_bot_to_discord
+# discord and promptlayer are only imported when they are used, so the CLI (see the bottom of this file) starts fast
+from botmerger import SingleTurnContext
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 
+from batching import BatchStats, batch_system_prompt, batch_user_prompt, parse_batch, plan_batches
+from bounded_merger import BoundedBotMerger
+from cache import response_cache
+from cancellation import RunCancelled, cancel_registry, cancellable_bot
+from completion import CompletionRequest
 from constants import DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS
-from utils import clean_dir
+from continuation import OutputBudget, output_budget
+from file_writer import OutputTree, StreamingFileWriter, atomic_write, run_io
+from hedging import hedger
+from job_queue import QueueFull, job_queue
+from ledger import SpendCapExceeded, ledger
+from llm_client import llm_client
+from manifest import RunManifest, RunPlan
+from pipeline import Pipeline
+from plan_parser import REPAIR_SYSTEM_PROMPT, PlanParseError, extract_filepaths, repair_max_tokens
+from retry import RetryBudget, retry_policy
+from routing import router, validate
+from scheduler import scheduler
+from streaming import ProgressReporter
+from token_counter import COUNT_TOKENS, acount_message_tokens, estimate_tokens
+from tracing import current_span, trace_bot, tracer
+from utils import remove_stale_files
 
 load_dotenv()
 
-promptlayer.api_key = os.environ["PROMPTLAYER_API_KEY"]
-DISCORD_BOT_SECRET = os.environ["DISCORD_BOT_SECRET"]
+DISCORD_BOT_SECRET = os.environ.get("DISCORD_BOT_SECRET")
+# set SMOL_STREAM=0 to wait for every file in full instead of streaming it to disk
+STREAM_FILES = os.environ.get("SMOL_STREAM", "1") != "0"
+# set SMOL_BATCH=1 to generate small files several at a time, see batching.py
+BATCH_FILES = os.environ.get("SMOL_BATCH", "0") == "1"
 
-discord_client = discord.Client(intents=discord.Intents.default())
+if os.environ.get("PROMPTLAYER_API_KEY"):
+    import promptlayer
 
-openai = promptlayer.openai
-# Set up your OpenAI API credentials
-openai.api_key = os.environ["OPENAI_API_KEY"]
+    promptlayer.api_key = os.environ["PROMPTLAYER_API_KEY"]
+    llm_client.use(promptlayer.openai)
+# without PromptLayer (e.g. in the benchmarks, against the local mock server) requests go to OpenAI directly
 
-merger = InMemoryBotMerger()
+# the bot runs for a long time, so old messages (and big ones) are spilled to disk once no bot works on them anymore,
+# see bounded_merger.py
+merger = BoundedBotMerger.from_env()
+
+# retry budgets of the runs that are in progress, by run id
+run_retry_budgets: dict[str, RetryBudget] = {}
+# the output budgets of the runs in progress as they were when the run started, by run id, see continuation.py
+run_output_budgets: dict[str, OutputBudget] = {}
 
 
 class GenerateResponse(BaseModel):
@@ -34,48 +64,93 @@ class GenerateResponse(BaseModel):
     system_prompt: str
     args: list[str] = Field(default_factory=list)
     model: str = DEFAULT_MODEL
+    run_id: Optional[str] = None
+    # what the request is for within the run ("filepaths", "shared_dependencies", "files"), for the ledger
+    stage: Optional[str] = None
+    # stream the reply as interim `StreamDelta` responses before yielding it in full as the final response
+    stream: bool = False
+    # per request, a reply that gets cut off at this length is continued with further requests
+    max_tokens: int = DEFAULT_MAX_TOKENS
+
+
+class StreamDelta(BaseModel):
+    delta: str = ""
+    # part of the reply was already streamed when the request failed and got retried, the consumer has to start over
+    restart: bool = False
 
 
 @merger.create_bot("ResponseGenerator")
+@merger.keep_in_flight
+@trace_bot("ResponseGenerator")
+@cancellable_bot
 async def generate_response(context: SingleTurnContext) -> None:
     data = GenerateResponse(**context.request.content)
-
-    def reportTokens(prompt):
-        encoding = tiktoken.encoding_for_model(data.model)
-        # print number of tokens in light gray, with first 50 characters of prompt in green. if truncated, show that
-        # it is truncated
-        # TODO send this to the UserProxyBot
-        print(
-            "\033[37m" + str(len(encoding.encode(prompt))) + " tokens\033[0m" + " in prompt: " + "\033[92m" +
-            prompt[:50] + "\033[0m" + ("..." if len(prompt) > 50 else "")
-        )
+    span = current_span()
+    # stays True when the reply comes from the cache (or from an identical request that was already in flight)
+    span.set(cached=True)
 
     messages = []
     messages.append({"role": "system", "content": data.system_prompt})
-    reportTokens(data.system_prompt)
     messages.append({"role": "user", "content": data.user_prompt})
-    reportTokens(data.user_prompt)
     # Loop through each value in `args` and add it to messages alternating role between "assistant" and "user"
     role = "assistant"
     for value in data.args:
         messages.append({"role": role, "content": value})
-        reportTokens(value)
         role = "user" if role == "assistant" else "assistant"
 
+    # a run that is over its spend cap or cancelled doesn't get to make (or wait for) the call at all
+    ledger.check(data.run_id)
+    token = cancel_registry.get(data.run_id)
+    if token is not None:
+        token.check()
+
+    # token counting happens in a worker thread while the request is in flight, so it never stalls the event loop
+    token_counting = asyncio.create_task(acount_message_tokens(messages, data.model)) if COUNT_TOKENS else None
+
     params = {
         "model": data.model,
         "messages": messages,
-        "max_tokens": DEFAULT_MAX_TOKENS,
+        "max_tokens": data.max_tokens,
         "temperature": 0,
     }
 
-    # Send the API request
-    response = await openai.ChatCompletion.acreate(**params)
+    # the requests that make the reply, see completion.py
+    request = CompletionRequest(
+        params,
+        run_id=data.run_id,
+        user=context.request.original_initiator.name,
+        stage=data.stage,
+        on_delta=(lambda **delta: context.yield_interim_response(StreamDelta(**delta))) if data.stream else None,
+    )
+
+    async def create_reply() -> str:
+        span.set(cached=False)
+        if token_counting:
+            prompt_tokens = sum(await token_counting)
+        else:
+            prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        return await request.complete(prompt_tokens, budget=run_retry_budgets.get(data.run_id))
+
+    # a cache hit skips the OpenAI round trip entirely (nothing is streamed in that case, there is only the final
+    # response), so nothing is spent either. A reply collapsed into another run's request is made here after all if
+    # that run fails for reasons of its own
+    try:
+        reply = await response_cache.aget_or_create(
+            params, create_reply, owner_errors=(SpendCapExceeded, RunCancelled)
+        )
 
-    # Get the reply from the API response
-    reply = response.choices[0]["message"]["content"]
+        extra_fields = {"cost": request.spent}
+        if token_counting:
+            token_counts = await token_counting
+            extra_fields["prompt_tokens"] = sum(token_counts)
+            extra_fields["message_tokens"] = token_counts
+            span.set(prompt_tokens=extra_fields["prompt_tokens"])
+    finally:
+        # the reply failed before the counts were needed, they are not left behind as a task nobody awaits
+        if token_counting and not token_counting.done():
+            token_counting.cancel()
 
-    await context.yield_final_response(reply)
+    await context.yield_final_response(reply, extra_fields=extra_fields)
 
 
 class GenerateFile(BaseModel):
@@ -84,22 +159,52 @@ class GenerateFile(BaseModel):
     shared_dependencies: str
     prompt: str
     model: str = DEFAULT_MODEL
+    run_id: Optional[str] = None
+    directory: str = DEFAULT_DIR
+    # stream the code straight into the file (and report `FileProgress` along the way) instead of waiting for all of it
+    stream: bool = False
+
+
+class FileProgress(BaseModel):
+    file: str
+    chars: int
+
+
+class FileRef(BaseModel):
+    """The final response of FileGenerator: the code is already written to `path`, only a reference to it is passed
+    around (and kept by the merger)."""
+
+    path: str
+    chars: int
+    # the model that generated the file, see routing.py
+    model: Optional[str] = None
 
 
 # def generate_file(filename, model=DEFAULT_MODEL, filepaths_string=None, shared_dependencies=None, prompt=None):
 @merger.create_bot("FileGenerator")
+@merger.keep_in_flight
+@trace_bot("FileGenerator")
+@cancellable_bot
 async def generate_file(context: SingleTurnContext) -> None:
     data = GenerateFile(**context.request.content)
 
     # TODO send this to the UserProxyBot
     print("file", data.file)
 
-    # call openai api with this prompt
-    await context.yield_final_response(
-        await generate_response.bot.get_final_response(
-            request=GenerateResponse(
-                model=data.model,
-                system_prompt=f"""You are an AI developer who is trying to write a program that will generate code \
+    # the model is picked per file, see routing.py
+    route, model = router.route(data.file, data.model, data.shared_dependencies)
+    current_span().set(route=route, model=model)
+
+    def make_request(model: str) -> GenerateResponse:
+        # call openai api with this prompt
+        return GenerateResponse(
+            model=model,
+            run_id=data.run_id,
+            stage="files",
+            stream=data.stream,
+            # big files get room to fit into one reply, small ones don't reserve a budget they never use
+            max_tokens=run_output_budgets.get(data.run_id, output_budget).max_tokens(data.file, model),
+            system_prompt=f"""You are an AI developer who is trying to write a program that will generate code \
 for the user based on their intent.
 
 the app is: {data.prompt}
@@ -110,7 +215,7 @@ the shared dependencies (like filenames and variable names) we have decided on a
 
 only write valid code for the given filepath and file type, and return only the code.
 do not add any other explanation, only return valid code for that file type.""",
-                user_prompt=f"""We have broken up the program into per-file generation.
+            user_prompt=f"""We have broken up the program into per-file generation.
 Now your job is to generate only the code for the file {data.file}.
 Make sure to have consistent filenames if you reference other files we are also generating.
 
@@ -129,11 +234,80 @@ Good response:
 console.log("hello world")
 
 Begin generating the code now.""",
-            ),
-            sender=context.this_bot,
-            channel=context.channel,
         )
-    )
+
+    file_path = os.path.join(data.directory, data.file)
+    # the file only appears under its name once it is complete, a failed generation leaves nothing half written behind
+    writer = StreamingFileWriter(file_path) if data.stream else None
+
+    async def generate_code(model: str) -> tuple[str, float]:
+        """The code of the file (streamed into `writer` along the way when streaming) and what generating it cost."""
+        if writer is None:
+            reply = await generate_response.bot.get_final_response(
+                request=make_request(model),
+                sender=context.this_bot,
+                channel=context.channel,
+            )
+            return reply.content, reply.extra_fields.get("cost", 0.0)
+
+        responses = await generate_response.bot.trigger(
+            make_request(model), sender=context.this_bot, channel=context.channel
+        )
+        async for message in responses:
+            if isinstance(message.content, str):
+                # the final response, the whole file
+                continue
+            delta = StreamDelta(**message.content)
+            if delta.restart:
+                await writer.reset()
+            await writer.write(delta.delta)
+            await context.yield_interim_response(FileProgress(file=data.file, chars=writer.chars_written))
+
+        reply = await responses.get_final_response()
+        if writer.chars_written == 0:
+            # the reply came from the cache, so nothing was streamed
+            await writer.write(reply.content)
+        return reply.content, reply.extra_fields.get("cost", 0.0)
+
+    async def attempt(model: str, escalated: bool = False) -> tuple[str, Optional[str]]:
+        started = time.monotonic()
+        filecode, call_cost = await generate_code(model)
+        problem = validate(data.file, filecode)
+        await run_io(
+            router.record,
+            data.run_id,
+            data.file,
+            route,
+            model,
+            problem is None,
+            time.monotonic() - started,
+            call_cost,
+            escalated,
+        )
+        return filecode, problem
+
+    try:
+        filecode, problem = await attempt(model)
+        if problem is not None and route == "cascade":
+            # TODO send this to the UserProxyBot
+            print(f"{data.file} from {model} failed validation ({problem}), generating it with {data.model}")
+            current_span().set(escalated=True)
+            if writer is not None:
+                await writer.reset()
+            model = data.model
+            filecode, problem = await attempt(model, escalated=True)
+        if writer is None:
+            await run_io(atomic_write, file_path, filecode)
+        else:
+            await writer.close()
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        raise
+
+    output_budget.record(data.file, estimate_tokens(filecode))
+    current_span().set(chars=len(filecode))
+    await context.yield_final_response(FileRef(path=file_path, chars=len(filecode), model=model))
 
 
 class SmolAI(BaseModel):
@@ -141,9 +315,15 @@ class SmolAI(BaseModel):
     directory: str = DEFAULT_DIR
     model: str = DEFAULT_MODEL
     file: str = None
+    run_id: str = Field(default_factory=lambda: uuid4().hex)
+    batch: bool = BATCH_FILES
+    # seconds the run may take before it is cancelled, SMOL_RUN_DEADLINE if unset, 0 for no deadline
+    deadline: Optional[float] = None
 
 
 @merger.create_bot("SmolAI")
+@merger.keep_in_flight
+@trace_bot("SmolAI")
 async def smol_ai(context: SingleTurnContext) -> None:
     data = SmolAI(**context.request.content)
 
@@ -152,11 +332,22 @@ async def smol_ai(context: SingleTurnContext) -> None:
     # print the prompt in green color
     print("\033[92m" + data.prompt + "\033[0m")
 
-    # call openai api with this prompt
-    filepaths_msg = await generate_response.bot.get_final_response(
-        request=GenerateResponse(
-            model=data.model,
-            system_prompt="""You are an AI developer who is trying to write a program that will generate code \
+    # a full run writes into a staging copy of the output directory that replaces the real one only once the run is
+    # over, regenerating a single file writes it in place
+    output = OutputTree(data.directory, staged=data.file is None)
+
+    # the stages of a run form a DAG: the filepaths and the shared dependencies are planned concurrently (the shared
+    # dependencies prompt only ever gets to see the app prompt) and file generation starts as soon as both are ready
+    pipeline = Pipeline()
+
+    async def plan_filepaths() -> str:
+        # call openai api with this prompt
+        filepaths_msg = await generate_response.bot.get_final_response(
+            request=GenerateResponse(
+                model=data.model,
+                run_id=data.run_id,
+                stage="filepaths",
+                system_prompt="""You are an AI developer who is trying to write a program that will generate code \
 for the user based on their intent.
 
 When given their intent, create a complete, exhaustive list of filepaths that the user would write to make the \
@@ -164,51 +355,87 @@ program.
 
 only list the filepaths you would write, and return them as a python list of strings. 
 do not add any other explanation, only return a python list of strings.""",
-            user_prompt=data.prompt,
-        ),
-        sender=context.this_bot,
-        channel=context.channel,
-    )
-    filepaths_string = filepaths_msg.content
-
-    # TODO send this to the UserProxyBot
-    print(filepaths_string)
-
-    async def call_file_generation_bot(_file: str) -> None:
-        file_response = await generate_file.bot.get_final_response(
-            request=GenerateFile(
-                model=data.model,
-                file=_file,
-                filepaths_string=filepaths_string,
-                shared_dependencies=shared_dependencies,
-                prompt=data.prompt,
+                user_prompt=data.prompt,
             ),
             sender=context.this_bot,
             channel=context.channel,
         )
-        filecode = file_response.content
-        write_file(_file, filecode, data.directory)
+        filepaths_string = filepaths_msg.content
 
-    try:
-        # parse the result into a python list
-        list_actual = ast.literal_eval(filepaths_string)
+        # TODO send this to the UserProxyBot
+        print(filepaths_string)
+        return filepaths_string
+
+    async def parse_file_list(filepaths: str) -> list[str]:
+        # parse the result into a python list, whatever shape it came back in
+        try:
+            list_actual = extract_filepaths(filepaths)
+        except PlanParseError:
+            # one cheap request to put the plan into shape rather than planning (or rerunning) everything again
+            # TODO send this to the UserProxyBot
+            print("failed to parse the plan, asking for it to be repaired")
+            repaired_msg = await generate_response.bot.get_final_response(
+                request=GenerateResponse(
+                    model=router.fast_model,
+                    run_id=data.run_id,
+                    stage="plan_repair",
+                    max_tokens=repair_max_tokens(filepaths),
+                    system_prompt=REPAIR_SYSTEM_PROMPT,
+                    user_prompt=filepaths,
+                ),
+                sender=context.this_bot,
+                channel=context.channel,
+            )
+            list_actual = extract_filepaths(repaired_msg.content)
         await context.yield_interim_response(list_actual)
+        return list_actual
 
+    def read_shared_dependencies() -> Optional[str]:
         # if shared_dependencies.md is there, read it in, else set it to None
-        shared_dependencies = None
-        if os.path.exists("shared_dependencies.md"):
-            with open("shared_dependencies.md", "r") as shared_dependencies_file:
-                shared_dependencies = shared_dependencies_file.read()
-
-        if data.file is not None:
-            await call_file_generation_bot(data.file)
-        else:
-            clean_dir(data.directory)
-
+        shared_dependencies_path = os.path.join(output.root, "shared_dependencies.md")
+        if not os.path.exists(shared_dependencies_path):
+            return None
+        with open(shared_dependencies_path, "r") as shared_dependencies_file:
+            return shared_dependencies_file.read()
+
+    if data.file is not None:
+        # the plan of the last full run makes the file itself the only LLM call, without one the filepaths are planned
+        # again
+
+        @pipeline.stage("plan")
+        async def load_plan() -> Optional[RunPlan]:
+            plan = await run_io(RunPlan.load, output.root)
+            # TODO send this to the UserProxyBot
+            if plan is None:
+                print(f"no plan in {output.root}, planning the filepaths again")
+            elif not plan.made_for(data.prompt):
+                print("the prompt changed since the last full run, keeping its filepaths and shared dependencies")
+            return plan
+
+        @pipeline.stage("filepaths", inputs=("plan",))
+        async def load_filepaths(plan: Optional[RunPlan]) -> str:
+            return plan.filepaths_string if plan is not None else await plan_filepaths()
+
+        @pipeline.stage("file_list", inputs=("plan", "filepaths"))
+        async def load_file_list(plan: Optional[RunPlan], filepaths: str) -> list[str]:
+            return plan.files if plan is not None else await parse_file_list(filepaths)
+
+        @pipeline.stage("shared_dependencies", inputs=("plan",))
+        async def load_shared_dependencies(plan: Optional[RunPlan]) -> Optional[str]:
+            return plan.shared_dependencies if plan is not None else await run_io(read_shared_dependencies)
+
+    else:
+        pipeline.add_stage("filepaths", plan_filepaths)
+        pipeline.add_stage("file_list", parse_file_list, inputs=("filepaths",))
+
+        @pipeline.stage("shared_dependencies")
+        async def plan_shared_dependencies() -> str:
             # understand shared dependencies
             shared_dependencies_msg = await generate_response.bot.get_final_response(
                 request=GenerateResponse(
                     model=data.model,
+                    run_id=data.run_id,
+                    stage="shared_dependencies",
                     system_prompt="""You are an AI developer who is trying to write a program that will \
 generate code for the user based on their intent.
 
@@ -247,42 +474,226 @@ Exclusively focus on the names of the shared dependencies, and do not add any ot
             #     conv_sequence.yield_outgoing(usr_msg)
 
             # write shared dependencies as a md file inside the generated directory
-            write_file("shared_dependencies.md", shared_dependencies, data.directory)
+            await output.write("shared_dependencies.md", shared_dependencies)
+            log_file("shared_dependencies.md", len(shared_dependencies))
+            return shared_dependencies
+
+    @pipeline.stage("files", inputs=("filepaths", "file_list", "shared_dependencies"))
+    async def generate_files(filepaths: str, file_list: list[str], shared_dependencies: Optional[str]) -> list[str]:
+        """Returns the files that failed to generate."""
+
+        async def call_file_generation_bot(_file: str) -> None:
+            file_responses = await generate_file.bot.trigger(
+                GenerateFile(
+                    model=data.model,
+                    run_id=data.run_id,
+                    file=_file,
+                    filepaths_string=filepaths,
+                    shared_dependencies=shared_dependencies,
+                    prompt=data.prompt,
+                    directory=output.root,
+                    stream=STREAM_FILES,
+                ),
+                sender=context.this_bot,
+                channel=context.channel,
+            )
+            async for message in file_responses:
+                if "path" in message.content:
+                    # the final response, a `FileRef`
+                    continue
+                progress_report = progress.update(**message.content)
+                if progress_report:
+                    await context.yield_interim_response(progress_report)
+
+            file_ref = FileRef(**(await file_responses.get_final_response()).content)
+            generated_with[_file] = file_ref.model or data.model
+            log_file(_file, file_ref.chars)
+            # surface every file as soon as it is ready rather than at the end of the whole batch
+            await context.yield_interim_response(progress.finish(_file))
+
+        # the model every file was generated with, files generated in a batch are generated with the run's model
+        generated_with: dict[str, str] = {}
+        batch_prefix = batch_system_prompt(data.prompt, filepaths, shared_dependencies)
+        batch_stats = BatchStats()
+        # the batch every file belongs to (files that get a request of their own have none), and the batch requests
+        batch_of: dict[str, tuple[str, ...]] = {}
+        batch_requests: dict[tuple[str, ...], asyncio.Task] = {}
+
+        async def generate_batch(files: tuple[str, ...]) -> dict[str, str]:
+            try:
+                batch_msg = await generate_response.bot.get_final_response(
+                    request=GenerateResponse(
+                        model=data.model,
+                        run_id=data.run_id,
+                        stage="files",
+                        system_prompt=batch_prefix,
+                        user_prompt=batch_user_prompt(list(files), data.prompt),
+                    ),
+                    sender=context.this_bot,
+                    channel=context.channel,
+                )
+                codes = parse_batch(batch_msg.content, list(files))
+            except (SpendCapExceeded, RunCancelled):
+                raise
+            except Exception as e:
+                # TODO send this to the UserProxyBot
+                print(f"failed to generate {', '.join(files)} in one go, generating them one by one: {e}")
+                codes = {}
+            batch_stats.record_batch(len(files), len(codes), batch_prefix)
+            return codes
+
+        async def generate(_file: str) -> None:
+            files = batch_of.get(_file)
+            if files is None:
+                batch_stats.record_single()
+            else:
+                if files not in batch_requests:
+                    batch_requests[files] = asyncio.ensure_future(generate_batch(files))
+                codes = await batch_requests[files]
+                if _file in codes:
+                    await output.write(_file, codes[_file])
+                    output_budget.record(_file, estimate_tokens(codes[_file]))
+                    log_file(_file, len(codes[_file]))
+                    await context.yield_interim_response(progress.finish(_file))
+                    return
+            # not batched, or the batch didn't bring this file back complete
+            await call_file_generation_bot(_file)
+
+        async def generate_and_track(_file: str) -> None:
+            try:
+                await generate(_file)
+            except SpendCapExceeded as e:
+                # the other files would run into the cap as well, no point in letting them get that far
+                token.cancel(f"stopped at its spend cap ({e})")
+                raise
+            generated.append(_file)
 
-            await asyncio.gather(*[call_file_generation_bot(f) for f in list_actual])
+        if data.file is not None:
+            progress = ProgressReporter(1)
+            await output.prepare_dirs([data.file])
+            await call_file_generation_bot(data.file)
+            generated.append(data.file)
+            return []
+
+        # regenerating a single file later on loads this plan rather than making it again
+        plan = RunPlan.create(data.prompt, data.model, filepaths, file_list, shared_dependencies)
+        await output.run(plan.save, output.root)
+        # files that are no longer part of the plan go away, the rest may be kept (see the manifest below)
+        await output.run(remove_stale_files, output.root, file_list + ["shared_dependencies.md"])
+
+        # only regenerate the files whose inputs changed since the last run
+        manifest = await output.run(RunManifest, output.root)
+        inputs = manifest.inputs(data.prompt, filepaths, shared_dependencies, data.model)
+
+        def file_inputs(f: str) -> dict:
+            # a file generated with the run's model is kept whatever the routing, one generated with the fast model
+            # only while files like it are still routed to the fast model
+            _, model = router.route(f, data.model, shared_dependencies)
+            if manifest.files.get(f, {}).get("model") == data.model:
+                model = data.model
+            return dict(inputs, model=model)
+
+        files_to_generate = [f for f in file_list if manifest.changed_inputs(f, file_inputs(f))]
+        if len(files_to_generate) < len(file_list):
+            await context.yield_interim_response(
+                f"{len(file_list) - len(files_to_generate)} files are unchanged since the last run, "
+                f"regenerating {len(files_to_generate)}"
+            )
+        progress = ProgressReporter(len(files_to_generate))
+        # all the directories the files go to are created in one go, not once per file
+        await output.prepare_dirs(files_to_generate)
+        if data.batch:
+            for files in plan_batches(files_to_generate):
+                if len(files) > 1:
+                    batch_of.update((f, tuple(files)) for f in files)
+
+        try:
+            # a file that fails to generate should not take the rest of the run down with it
+            results = await asyncio.gather(*[generate_and_track(f) for f in files_to_generate], return_exceptions=True)
+        finally:
+            # also when the run is cancelled: the files that are done are kept, the next run picks up from there
+            for f in files_to_generate:
+                if f in generated:
+                    manifest.record(f, dict(inputs, model=generated_with.get(f, data.model)))
+                else:
+                    manifest.forget(f)
+            await output.run(manifest.save)
+            await run_io(output_budget.save)
+        failed_files = [f for f, result in zip(files_to_generate, results) if isinstance(result, Exception)]
+        if data.batch:
+            # TODO send this to the UserProxyBot
+            print(batch_stats.report())
+        return failed_files
+
+    run_retry_budgets[data.run_id] = RetryBudget()
+    run_output_budgets[data.run_id] = output_budget.snapshot()
+    # the files generated so far, what a run that is stopped halfway through has to show for itself
+    generated: list[str] = []
+    # cancelling the token (or the deadline passing) cancels every bot working on the run, see cancellation.py
+    token = cancel_registry.open(data.run_id, context.request.original_initiator.name, data.deadline)
+    try:
+        try:
+            with token.guard():
+                # runs writing to the same directory take turns, the wait for the turn counts against the deadline
+                await output.begin()
+                failed_files = (await pipeline.run())["files"]
+        except (SpendCapExceeded, RunCancelled):
+            # keep the files that were already paid for, the manifest lets the next run pick up where this one stopped
+            await output.commit()
+            raise
+        except BaseException:
+            await output.abort()
+            raise
+        await output.commit()
 
+        # TODO send this to the UserProxyBot
+        print(pipeline.report())
+        print(response_cache.stats())
+        print(scheduler.stats())
+        print(retry_policy.stats())
+        print(tracer.stats())
+        print(merger.stats())
+        print(router.stats())
+        print(hedger.stats())
+        print(ledger.run_summary(data.run_id))
+
+        if failed_files:
+            await context.yield_final_response(f"DONE, but failed to generate: {', '.join(failed_files)}")
+        else:
             await context.yield_final_response("DONE!")
+    except (SpendCapExceeded, RunCancelled) as e:
+        print(pipeline.report())
+        print(ledger.run_summary(data.run_id))
+        if generated:
+            await context.yield_final_response(
+                f"STOPPED: {e}. Kept the {len(generated)} files generated so far: {', '.join(generated)}"
+            )
+        else:
+            await context.yield_final_response(f"STOPPED: {e}")
     except ValueError:
         await context.yield_interim_response("Failed to parse result")
         await context.yield_final_response(traceback.format_exc())
+    finally:
+        del run_retry_budgets[data.run_id]
+        del run_output_budgets[data.run_id]
+        ledger.finish_run(data.run_id)
+        cancel_registry.close(data.run_id)
 
 
-def write_file(filename, filecode, directory):
-    # Output the filename in blue color
-    print("\033[94m" + filename + "\033[0m")
-    print(filecode)
-
-    file_path = os.path.join(directory, filename)
-    _dir = os.path.dirname(file_path)
-
-    # Check if the filename is actually a directory
-    if os.path.isdir(file_path):
-        print(f"Error: {filename} is a directory, not a file.")
-        return
-
-    os.makedirs(_dir, exist_ok=True)
-
-    # Open the file in write mode
-    with open(file_path, "w") as file:
-        # Write content to the file
-        file.write(filecode)
+def log_file(filename, chars):
+    # Output the filename in blue color, followed by the size of the file rather than all of its code
+    print("\033[94m" + filename + "\033[0m" + f" ({chars} chars)")
 
 
 @merger.create_bot("MainBot")
+@merger.keep_in_flight
+@trace_bot("MainBot")
 async def main(context: SingleTurnContext) -> None:
     data = SmolAI(
         prompt=context.request.content,
         model="gpt-4",
+        # the whole run is traced under one id
+        run_id=current_span().trace_id,
     )
 
     # read file from prompt if it ends in a .md filetype
@@ -302,15 +713,110 @@ async def main(context: SingleTurnContext) -> None:
 # )
 
 
-@discord_client.event
-async def on_ready() -> None:
-    """Called when the client is done preparing the data received from Discord."""
-    print("Logged in as", discord_client.user)
-    print()
+@merger.create_bot("QueueBot")
+@merger.keep_in_flight
+@trace_bot("QueueBot")
+async def queue_bot(context: SingleTurnContext) -> None:
+    """Admission control in front of MainBot, see job_queue.py. "cancel" cancels the user's runs instead."""
+    user = context.request.original_initiator.name
+    if isinstance(context.request.content, str) and context.request.content.strip().lower() == "cancel":
+        running = cancel_registry.cancel_user(user, "was cancelled by its user")
+        waiting = job_queue.cancel_waiting(user)
+        if running or waiting:
+            await context.yield_final_response(f"Cancelled {running} running and {waiting} waiting runs")
+        else:
+            await context.yield_final_response("You have no runs to cancel")
+        return
 
+    try:
+        job = job_queue.submit(user)
+    except QueueFull as e:
+        await context.yield_final_response(f"Sorry, {e}")
+        return
 
-inquiry_bot = create_inquiry_bot(main.bot)
+    try:
+        reported_position = None
+        while job.started is None:
+            if job.cancelled:
+                await context.yield_final_response("Cancelled before it started")
+                return
+            position = job_queue.position(job)
+            if position != reported_position:
+                eta_minutes = max(1, round(job_queue.eta(job) / 60))
+                await context.yield_interim_response(
+                    f"you are #{position} in the queue, starting in about {eta_minutes} min"
+                )
+                reported_position = position
+            await job.wait_for_change()
+
+        await context.yield_from(
+            await main.bot.trigger(context.request.content, sender=context.this_bot, channel=context.channel)
+        )
+    finally:
+        job_queue.done(job)
+        # TODO send this to the UserProxyBot
+        print(job_queue.stats())
 
-if __name__ == "__main__":
+
+def run_discord_bot() -> None:
+    import discord
+    from botmerger.experimental.inquiry_bot import create_inquiry_bot
+    from botmerger.ext.discord_integration import attach_bot_to_discord
+
+    discord_client = discord.Client(intents=discord.Intents.default())
+
+    @discord_client.event
+    async def on_ready() -> None:
+        """Called when the client is done preparing the data received from Discord."""
+        print("Logged in as", discord_client.user)
+        print()
+
+    inquiry_bot = create_inquiry_bot(queue_bot.bot)
     attach_bot_to_discord(inquiry_bot, discord_client)
     discord_client.run(DISCORD_BOT_SECRET)
+
+
+async def run_cli(data: SmolAI) -> None:
+    """One run straight from the command line, without discord (and without the queue in front of it)."""
+    responses = await smol_ai.bot.trigger(data)
+    async for response in responses:
+        if isinstance(response.content, str):
+            print(response.content)
+    await llm_client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="run the smol developer bot on discord, or with a prompt, once from the command line"
+    )
+    parser.add_argument(
+        "prompt", nargs="?", help="the app to generate (or a .md file with it), runs the discord bot if omitted"
+    )
+    parser.add_argument("--directory", "-d", default=DEFAULT_DIR)
+    parser.add_argument("--model", "-m", default=DEFAULT_MODEL)
+    parser.add_argument("--file", "-f", help="only regenerate this file of an earlier run")
+    parser.add_argument(
+        "--batch", "-b", action="store_true", default=BATCH_FILES, help="generate small files several at a time"
+    )
+    parser.add_argument(
+        "--deadline", type=float, help="seconds the run may take, SMOL_RUN_DEADLINE if unset, 0 for none"
+    )
+    args = parser.parse_args()
+
+    if args.prompt is None:
+        run_discord_bot()
+    else:
+        prompt = args.prompt
+        # read file from prompt if it ends in a .md filetype
+        if prompt.endswith(".md"):
+            with open(prompt, "r") as promptfile:
+                prompt = promptfile.read()
+        data = SmolAI(
+            prompt=prompt,
+            directory=args.directory,
+            model=args.model,
+            file=args.file,
+            batch=args.batch,
+            deadline=args.deadline,
+        )
+        asyncio.run(run_cli(data))
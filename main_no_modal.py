@@ -1,68 +1,83 @@
 import sys
 import os
-import ast
-from time import sleep
-from utils import clean_dir
-from constants import DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS
-
-def generate_response(system_prompt, user_prompt, *args):
-    import openai
-    import tiktoken
-
-    def reportTokens(prompt):
-        encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
-        # print number of tokens in light gray, with first 10 characters of prompt in green
-        print(
-            "\033[37m"
-            + str(len(encoding.encode(prompt)))
-            + " tokens\033[0m"
-            + " in prompt: "
-            + "\033[92m"
-            + prompt[:50]
-            + "\033[0m"
-        )
-
-    # Set up your OpenAI API credentials
-    openai.api_key = os.environ["OPENAI_API_KEY"]
-
+import argparse
+import getpass
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from batching import BatchStats, batch_system_prompt, batch_user_prompt, parse_batch, plan_batches
+from cache import response_cache
+from continuation import continuation_messages, join_continuation, output_budget
+from ledger import SpendCapExceeded, ledger
+from llm_client import llm_client
+from retry import RetryBudget, retry_policy
+from token_counter import COUNT_TOKENS, count_message_tokens, estimate_tokens, report_tokens
+from manifest import RunManifest, RunPlan
+from plan_parser import REPAIR_SYSTEM_PROMPT, PlanParseError, extract_filepaths, repair_max_tokens
+from utils import remove_stale_files
+from constants import DEFAULT_CONCURRENCY, DEFAULT_DIR, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, MAX_CONTINUATIONS
+
+# retries shared by all the requests of this run
+run_retry_budget = RetryBudget()
+# the ledger accounts this run's spend under this id, and under the user running it
+run_id = uuid4().hex
+
+
+def generate_response(system_prompt, user_prompt, *args, stage=None, max_tokens=DEFAULT_MAX_TOKENS, log=print):
     messages = []
     messages.append({"role": "system", "content": system_prompt})
-    reportTokens(system_prompt)
     messages.append({"role": "user", "content": user_prompt})
-    reportTokens(user_prompt)
     # loop thru each arg and add it to messages alternating role between "assistant" and "user"
     role = "assistant"
     for value in args:
         messages.append({"role": role, "content": value})
-        reportTokens(value)
         role = "user" if role == "assistant" else "assistant"
+    if COUNT_TOKENS:
+        report_tokens(messages, count_message_tokens(messages, DEFAULT_MODEL), log=log)
 
     params = {
         "model": DEFAULT_MODEL,
         "messages": messages,
-        "max_tokens": DEFAULT_MAX_TOKENS,
+        "max_tokens": max_tokens,
         "temperature": 0,
     }
 
-    # Send the API request
-    keep_trying = True
-    while keep_trying:
-        try:
-            response = openai.ChatCompletion.create(**params)
-            keep_trying = False
-        except Exception as e:
-            # e.g. when the API is too busy, we don't want to fail everything
-            print("Failed to generate response. Error: ", e)
-            sleep(30)
-            print("Retrying...")
+    def send_request(request_params):
+        # no further requests once the run is over its spend cap
+        ledger.check(run_id)
+        # Send the API request (e.g. when the API is too busy, we don't want to fail everything, so transient errors
+        # are retried)
+        response = retry_policy.call(llm_client.create, **request_params, budget=run_retry_budget, log=log)
+        usage = response["usage"]
+        call_cost = ledger.record(
+            run_id, getpass.getuser(), DEFAULT_MODEL, stage, usage["prompt_tokens"], usage["completion_tokens"]
+        )
+        log(
+            "\033[37m" + str(usage["prompt_tokens"]) + " prompt + " + str(usage["completion_tokens"]) +
+            f" completion tokens, ${call_cost:.4f}\033[0m"
+        )
+
+        # Get the reply from the API response
+        return response.choices[0]["message"]["content"], response.choices[0].get("finish_reason")
 
-    # Get the reply from the API response
-    reply = response.choices[0]["message"]["content"]
-    return reply
+    def create_reply():
+        reply, finish_reason = send_request(params)
+        # a reply cut off by max_tokens is picked up where it stopped instead of ending up truncated on disk
+        for _ in range(MAX_CONTINUATIONS):
+            if finish_reason != "length":
+                break
+            log("\033[37mthe reply was cut off, continuing it\033[0m")
+            more, finish_reason = send_request(dict(params, messages=continuation_messages(messages, reply)))
+            reply = join_continuation(reply, more)
+        if finish_reason == "length":
+            log(f"the reply is still cut off after {MAX_CONTINUATIONS} continuations")
+        return reply
+
+    # a cache hit skips the OpenAI round trip entirely
+    return response_cache.get_or_create(params, create_reply)
 
 
 def generate_file(
-    filename, filepaths_string=None, shared_dependencies=None, prompt=None
+    filename, filepaths_string=None, shared_dependencies=None, prompt=None, budget=output_budget, log=print
 ):
     # call openai api with this prompt
     filecode = generate_response(
@@ -98,12 +113,86 @@ def generate_file(
     Begin generating the code now.
 
     """,
+        stage="files",
+        # big files get room to fit into one reply, small ones don't reserve a budget they never use
+        max_tokens=budget.max_tokens(filename, DEFAULT_MODEL),
+        log=log,
     )
+    output_budget.record(filename, estimate_tokens(filecode))
 
     return filename, filecode
 
 
-def main(prompt, directory=DEFAULT_DIR, file=None):
+def generate_files(names, directory, concurrency=DEFAULT_CONCURRENCY, batch=False, **kwargs):
+    """
+    Generate files concurrently on a thread pool. Every file is written as soon as its response arrives, but the
+    log of each file is buffered and printed in plan order, so the output is the same as that of a sequential run.
+    With `batch`, small files of the same type are generated several at a time with one request (see batching.py).
+    """
+
+    def generate_and_write(name, log):
+        try:
+            filename, filecode = generate_file(name, log=log, **kwargs)
+            write_file(filename, filecode, directory, log=log)
+        except Exception as e:
+            log("Failed to generate " + name + ". Error: ", e)
+            return False
+        return True
+
+    def generate_batch_and_write(files):
+        lines = []
+
+        def log(*values):
+            lines.append(" ".join(str(value) for value in values))
+
+        codes = None
+        if len(files) > 1:
+            try:
+                reply = generate_response(
+                    batch_prefix, batch_user_prompt(files, kwargs["prompt"]), stage="files", log=log
+                )
+                codes = parse_batch(reply, files)
+            except Exception as e:
+                log("Failed to generate " + ", ".join(files) + " in one go. Error: ", e)
+                codes = {}
+
+        failed = []
+        for name in files:
+            # files the batch didn't bring back complete get a request of their own
+            if codes and name in codes:
+                try:
+                    write_file(name, codes[name], directory, log=log)
+                    output_budget.record(name, estimate_tokens(codes[name]))
+                    continue
+                except Exception as e:
+                    log("Failed to write " + name + ". Error: ", e)
+            if not generate_and_write(name, log):
+                failed.append(name)
+        return lines, failed, codes
+
+    batches = plan_batches(names) if batch else [[name] for name in names]
+    batch_prefix = None
+    if batch:
+        batch_prefix = batch_system_prompt(kwargs["prompt"], kwargs["filepaths_string"], kwargs["shared_dependencies"])
+    stats = BatchStats()
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(generate_batch_and_write, files) for files in batches]
+        for files, future in zip(batches, futures):
+            lines, batch_failed, codes = future.result()
+            print("\n".join(lines))
+            failed.extend(batch_failed)
+            if codes is None:
+                stats.record_single()
+            else:
+                stats.record_batch(len(files), len(codes), batch_prefix)
+    if batch:
+        print(stats.report())
+    return failed
+
+
+def main(prompt, directory=DEFAULT_DIR, file=None, concurrency=DEFAULT_CONCURRENCY, batch=False):
     # read file from prompt if it ends in a .md filetype
     if prompt.endswith(".md"):
         with open(prompt, "r") as promptfile:
@@ -117,8 +206,18 @@ def main(prompt, directory=DEFAULT_DIR, file=None):
     # a Chrome extension that, when clicked, opens a small window with a page where you can enter
     # a prompt for reading the currently open page and generating some response from openai
 
+    # max_tokens is part of the cache key, every file of the run gets its budget from the sizes known at its start
+    budget = output_budget.snapshot()
+
+    # regenerating a single file loads the plan of the last full run, which leaves that file as the only LLM call
+    plan = RunPlan.load(directory) if file is not None else None
+    if file is not None and plan is None:
+        print("No plan in " + directory + ", planning the filepaths again")
+    elif plan is not None and not plan.made_for(prompt):
+        print("The prompt changed since the last full run, keeping its filepaths and shared dependencies")
+
     # call openai api with this prompt
-    filepaths_string = generate_response(
+    filepaths_string = plan.filepaths_string if plan is not None else generate_response(
         """You are an AI developer who is trying to write a program that will generate code for the user based on their intent.
 
     When given their intent, create a complete, exhaustive list of filepaths that the user would write to make the program.
@@ -127,17 +226,20 @@ def main(prompt, directory=DEFAULT_DIR, file=None):
     do not add any other explanation, only return a python list of strings.
     """,
         prompt,
+        stage="filepaths",
     )
     print(filepaths_string)
     # parse the result into a python list
     list_actual = []
     try:
-        list_actual = ast.literal_eval(filepaths_string)
+        list_actual = plan.files if plan is not None else parse_plan(filepaths_string)
 
         # if shared_dependencies.md is there, read it in, else set it to None
         shared_dependencies = None
-        if os.path.exists("shared_dependencies.md"):
-            with open("shared_dependencies.md", "r") as shared_dependencies_file:
+        if plan is not None:
+            shared_dependencies = plan.shared_dependencies
+        elif os.path.exists(os.path.join(directory, "shared_dependencies.md")):
+            with open(os.path.join(directory, "shared_dependencies.md"), "r") as shared_dependencies_file:
                 shared_dependencies = shared_dependencies_file.read()
 
         if file is not None:
@@ -148,10 +250,12 @@ def main(prompt, directory=DEFAULT_DIR, file=None):
                 filepaths_string=filepaths_string,
                 shared_dependencies=shared_dependencies,
                 prompt=prompt,
+                budget=budget,
             )
             write_file(filename, filecode, directory)
         else:
-            clean_dir(directory)
+            # files that are no longer part of the plan go away, the rest may be kept (see the manifest below)
+            remove_stale_files(directory, keep=list_actual + ["shared_dependencies.md"])
 
             # understand shared dependencies
             shared_dependencies = generate_response(
@@ -170,28 +274,75 @@ def main(prompt, directory=DEFAULT_DIR, file=None):
             Exclusively focus on the names of the shared dependencies, and do not add any other explanation.
             """,
                 prompt,
+                stage="shared_dependencies",
             )
             print(shared_dependencies)
             # write shared dependencies as a md file inside the generated directory
             write_file("shared_dependencies.md", shared_dependencies, directory)
-
-            for name in list_actual:
-                filename, filecode = generate_file(
-                    name,
-                    filepaths_string=filepaths_string,
-                    shared_dependencies=shared_dependencies,
-                    prompt=prompt,
+            # regenerating a single file later on loads this plan rather than making it again
+            RunPlan.create(prompt, DEFAULT_MODEL, filepaths_string, list_actual, shared_dependencies).save(directory)
+
+            # only regenerate the files whose inputs changed since the last run
+            manifest = RunManifest(directory)
+            inputs = manifest.inputs(prompt, filepaths_string, shared_dependencies, DEFAULT_MODEL)
+            files_to_generate = [name for name in list_actual if manifest.changed_inputs(name, inputs)]
+            if len(files_to_generate) < len(list_actual):
+                print(
+                    f"{len(list_actual) - len(files_to_generate)} files are unchanged since the last run, "
+                    f"regenerating {len(files_to_generate)}"
                 )
-                write_file(filename, filecode, directory)
 
+            failed = generate_files(
+                files_to_generate,
+                directory,
+                concurrency,
+                batch,
+                filepaths_string=filepaths_string,
+                shared_dependencies=shared_dependencies,
+                prompt=prompt,
+                budget=budget,
+            )
+            for name in files_to_generate:
+                if name in failed:
+                    manifest.forget(name)
+                else:
+                    manifest.record(name, inputs)
+            manifest.save()
+            output_budget.save()
+            if failed:
+                print("Failed to generate: " + ", ".join(failed))
+
+        print(response_cache.stats())
+        print(retry_policy.stats())
+        print(ledger.run_summary(run_id))
+
+    except SpendCapExceeded as e:
+        print(ledger.run_summary(run_id))
+        print("Stopped: " + str(e))
     except ValueError:
-        print("Failed to parse result: " + result)
+        print("Failed to parse result: " + filepaths_string)
+
 
+def parse_plan(filepaths_string):
+    # whatever shape the plan came back in, only if there is no making sense of it, one cheap request puts it into
+    # shape rather than the whole run being repeated
+    try:
+        return extract_filepaths(filepaths_string)
+    except PlanParseError:
+        print("Failed to parse the plan, asking for it to be repaired")
+        repaired = generate_response(
+            REPAIR_SYSTEM_PROMPT,
+            filepaths_string,
+            stage="plan_repair",
+            max_tokens=repair_max_tokens(filepaths_string),
+        )
+        return extract_filepaths(repaired)
 
-def write_file(filename, filecode, directory):
+
+def write_file(filename, filecode, directory, log=print):
     # Output the filename in blue color
-    print("\033[94m" + filename + "\033[0m")
-    print(filecode)
+    log("\033[94m" + filename + "\033[0m")
+    log(filecode)
 
     file_path = directory + "/" + filename
     dir = os.path.dirname(file_path)
@@ -204,9 +355,31 @@ def write_file(filename, filecode, directory):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "prompt",
+        nargs="?",
+        help="The prompt, or a path to a .md file with the prompt. Defaults to prompt.md if it exists.",
+    )
+    parser.add_argument("directory", nargs="?", default=DEFAULT_DIR, help="The directory to generate the files in.")
+    parser.add_argument("file", nargs="?", help="Regenerate only this file.")
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="How many files to generate at the same time. 1 generates them one by one.",
+    )
+    parser.add_argument(
+        "--batch",
+        "-b",
+        action="store_true",
+        help="Generate small files of the same type several at a time, sending the shared prompt once per batch.",
+    )
+    args = parser.parse_args()
 
-    # Check for arguments
-    if len(sys.argv) < 2:
+    prompt = args.prompt
+    if prompt is None:
 
         # Looks like we don't have a prompt. Check if prompt.md exists
         if not os.path.exists("prompt.md"):
@@ -218,13 +391,5 @@ if __name__ == "__main__":
         # Still here? Assign the prompt file name to prompt
         prompt = "prompt.md"
 
-    else:
-        # Set prompt to the first argument
-        prompt = sys.argv[1]
-
-    # Pull everything else as normal
-    directory = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_DIR
-    file = sys.argv[3] if len(sys.argv) > 3 else None
-
     # Run the main function
-    main(prompt, directory, file)
+    main(prompt, args.directory, args.file, args.concurrency, args.batch)
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+MANIFEST_FILENAME = ".smol_manifest.json"
+PLAN_FILENAME = ".smol_plan.json"
+
+
+def hash_text(text) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class RunManifest:
+    """
+    Remembers what every generated file was generated from: the hashes of the app prompt, the filepath plan and the
+    shared dependencies, plus the model. The next run only regenerates files whose inputs changed (or that went
+    missing from disk) and keeps the rest without an LLM call.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self.files: dict[str, dict] = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.files = json.load(file)["files"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def inputs(prompt: str, filepaths_string: str, shared_dependencies: str, model: str) -> dict:
+        return {
+            "prompt": hash_text(prompt),
+            "plan": hash_text(filepaths_string),
+            "shared_dependencies": hash_text(shared_dependencies),
+            "model": model,
+        }
+
+    def changed_inputs(self, file: str, inputs: dict) -> list[str]:
+        """Names of the inputs the file needs to be regenerated for, an empty list if it is up to date."""
+        if not os.path.isfile(os.path.join(self.directory, file)):
+            return ["missing"]
+        entry = self.files.get(file)
+        if entry is None:
+            return ["new"]
+        return [name for name, value in inputs.items() if entry.get(name) != value]
+
+    def record(self, file: str, inputs: dict) -> None:
+        self.files[file] = dict(inputs)
+
+    def forget(self, file: str) -> None:
+        self.files.pop(file, None)
+
+    def save(self) -> None:
+        _save_json(self.directory, self.path, {"files": self.files})
+
+
+def _save_json(directory: str, path: str, content: dict) -> None:
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as file:
+        json.dump(content, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class RunPlan:
+    """
+    The plan of the last full run, kept next to its output: the filepath plan as the model wrote it and as parsed,
+    the shared dependencies, and what it was made from. Regenerating a single file loads it instead of planning again,
+    which leaves that one file as the only LLM call.
+    """
+
+    prompt_hash: str
+    model: str
+    filepaths_string: str
+    files: list[str]
+    shared_dependencies: Optional[str]
+
+    @classmethod
+    def create(
+        cls, prompt: str, model: str, filepaths_string: str, files: list[str], shared_dependencies: Optional[str]
+    ) -> "RunPlan":
+        return cls(hash_text(prompt), model, filepaths_string, list(files), shared_dependencies)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["RunPlan"]:
+        try:
+            with open(os.path.join(directory, PLAN_FILENAME), "r", encoding="utf-8") as file:
+                return cls(**json.load(file))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def made_for(self, prompt: str) -> bool:
+        return self.prompt_hash == hash_text(prompt)
+
+    def save(self, directory: str) -> None:
+        _save_json(directory, os.path.join(directory, PLAN_FILENAME), asdict(self))
@@ -0,0 +1,114 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Optional
+
+from tracing import tracer
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[..., Awaitable[Any]]
+    inputs: tuple[str, ...]
+    start: Optional[float] = None
+    end: Optional[float] = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+@dataclass
+class Pipeline:
+    """
+    A tiny DAG executor. Every stage declares the stages it takes its inputs from and gets their results as keyword
+    arguments. A stage starts as soon as all of its inputs are ready, so independent stages run concurrently.
+    """
+
+    stages: dict[str, Stage] = field(default_factory=dict)
+    started: Optional[float] = None
+
+    def stage(self, name: str, inputs: tuple[str, ...] = ()) -> Callable:
+        def decorator(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            self.add_stage(name, fn, inputs)
+            return fn
+
+        return decorator
+
+    def add_stage(self, name: str, fn: Callable[..., Awaitable[Any]], inputs: tuple[str, ...] = ()) -> None:
+        if name in self.stages:
+            raise ValueError(f"stage {name!r} is already defined")
+        self.stages[name] = Stage(name=name, fn=fn, inputs=tuple(inputs))
+
+    def _check(self) -> None:
+        visiting, done = set(), set()
+
+        def visit(name: str) -> None:
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"stage {name!r} depends on itself")
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                if input_name not in self.stages:
+                    raise ValueError(f"stage {name!r} takes input from an unknown stage {input_name!r}")
+                visit(input_name)
+            visiting.discard(name)
+            done.add(name)
+
+        for stage_name in self.stages:
+            visit(stage_name)
+
+    async def run(self) -> dict[str, Any]:
+        """Runs all the stages and returns their results by stage name. The first failure cancels everything else."""
+        self._check()
+        self.started = time.monotonic()
+        tasks: dict[str, asyncio.Task] = {}
+
+        async def run_stage(stage: Stage) -> Any:
+            inputs = {input_name: await tasks[input_name] for input_name in stage.inputs}
+            stage.start = time.monotonic()
+            try:
+                with tracer.span(stage.name, kind="stage"):
+                    return await stage.fn(**inputs)
+            finally:
+                stage.end = time.monotonic()
+
+        for stage in self.stages.values():
+            tasks[stage.name] = asyncio.create_task(run_stage(stage))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            # stages that got cancelled get to clean up (e.g. save what they have done so far) before the run goes on
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return {name: task.result() for name, task in tasks.items()}
+
+    def critical_path(self) -> list[Stage]:
+        """The chain of stages that determined the total run time (the last stage to finish and what it waited on)."""
+        finished = [stage for stage in self.stages.values() if stage.end is not None]
+        if not finished:
+            return []
+        path = [max(finished, key=lambda stage: stage.end)]
+        while path[-1].inputs:
+            path.append(max((self.stages[name] for name in path[-1].inputs), key=lambda stage: stage.end))
+        return list(reversed(path))
+
+    def report(self) -> str:
+        lines = ["stage timings (seconds since the start of the run):"]
+        for stage in sorted(self.stages.values(), key=lambda stage: stage.start or float("inf")):
+            if stage.end is None:
+                lines.append(f"  {stage.name}: did not run")
+                continue
+            lines.append(
+                f"  {stage.name}: {stage.start - self.started:.2f} -> {stage.end - self.started:.2f} "
+                f"({stage.duration:.2f})"
+            )
+        critical_path = self.critical_path()
+        if critical_path:
+            lines.append(
+                "critical path: " + " -> ".join(f"{stage.name} ({stage.duration:.2f})" for stage in critical_path)
+            )
+        return "\n".join(lines)
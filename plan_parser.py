@@ -0,0 +1,100 @@
+import ast
+import json
+import posixpath
+import re
+from typing import Optional
+
+from token_counter import estimate_tokens
+
+FENCE_PATTERN = re.compile(r"```[\w+-]*[ \t]*\n(.*?)```", re.DOTALL)
+BULLET_PATTERN = re.compile(r"^\s*(?:[-*+•]|\d+[.)])\s+(.+?)\s*$")
+# a line that is nothing but a path, e.g. in a plan that came back one file per line
+PATH_LINE_PATTERN = re.compile(r"^[\w./\\-]+\.[\w-]+$|^[\w./\\-]*[Mm]akefile$|^[\w./\\-]*Dockerfile$")
+MAX_PATH_CHARS = 255
+# a path with spaces in it and more words than this is a sentence rather than a file name
+MAX_PATH_WORDS = 6
+
+REPAIR_SYSTEM_PROMPT = """You convert a list of file paths written in any form into a JSON array of strings, one \
+string per file path, in the same order. Return only the JSON array, without any other text or code fences."""
+
+
+class PlanParseError(ValueError):
+    """The filepath plan could not be made sense of, not even with the repair request."""
+
+
+def normalize_path(path: str) -> Optional[str]:
+    """The path relative to the output directory, in posix form, or None if it is not a usable file path."""
+    path = path.strip().strip(",").strip().strip("`'\"").strip()
+    # a comment after the path, e.g. "- popup.js: the popup's logic" or "popup.js  # the popup's logic"
+    path = re.split(r"\s+#|:\s|\s+-\s|\s+\(", path, maxsplit=1)[0].strip().strip("`'\"")
+    path = path.replace("\\", "/")
+    if not path or path.endswith("/") or "\0" in path or re.match(r"^[A-Za-z]:/", path):
+        return None
+    path = posixpath.normpath(path.lstrip("/"))
+    if path in (".", "") or path.split("/")[0] == ".." or len(path) > MAX_PATH_CHARS or _is_prose(path):
+        return None
+    return path
+
+
+def _is_prose(path: str) -> bool:
+    """File names may have spaces ("prompt used for this extension.md"), prose rarely ends in an extension."""
+    if " " not in path:
+        return False
+    return not re.search(r"\.[\w-]+$", posixpath.basename(path)) or len(path.split()) > MAX_PATH_WORDS
+
+
+def _literal_list(text: str) -> Optional[list]:
+    start, end = text.find("["), text.rfind("]")
+    if start == -1 or end < start:
+        return None
+    candidate = text[start : end + 1]
+    for parse in (ast.literal_eval, json.loads):
+        try:
+            value = parse(candidate)
+        except (SyntaxError, ValueError, TypeError, MemoryError, RecursionError):
+            continue
+        if isinstance(value, (list, tuple)) and all(isinstance(item, str) for item in value):
+            return list(value)
+    return None
+
+
+def _listed_lines(text: str) -> Optional[list[str]]:
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    bullets = [match.group(1) for match in map(BULLET_PATTERN.match, lines) if match]
+    if bullets:
+        return bullets
+    paths = [line for line in lines if PATH_LINE_PATTERN.match(line.strip("`'\",").strip())]
+    return paths or None
+
+
+def extract_filepaths(text: str) -> list[str]:
+    """
+    The file paths of a plan the model was asked to return as a python list of strings, whatever it actually
+    returned: the list itself, the list in a code fence or between prose, a JSON array, or a bulleted, numbered or
+    plain list of one path per line. Raises `PlanParseError` if there are none.
+    """
+    candidates = FENCE_PATTERN.findall(text) + [text]
+    for candidate in candidates:
+        paths = _literal_list(candidate)
+        if paths is None:
+            paths = _listed_lines(candidate)
+        if paths:
+            normalized = normalize_plan(paths)
+            if normalized:
+                return normalized
+    raise PlanParseError(f"found no file paths in the plan: {text[:200]!r}")
+
+
+def normalize_plan(paths: list[str]) -> list[str]:
+    """The usable paths of the plan, normalized, without duplicates, in plan order."""
+    normalized = {}
+    for path in paths:
+        path = normalize_path(path)
+        if path is not None:
+            normalized.setdefault(path, None)
+    return list(normalized)
+
+
+def repair_max_tokens(text: str) -> int:
+    # the repaired plan is the paths alone, never much longer than the reply they are taken from
+    return estimate_tokens(text) + 100
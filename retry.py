@@ -0,0 +1,181 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from constants import RETRY_BASE_DELAY, RETRY_MAX_ATTEMPTS, RETRY_MAX_DELAY, RETRY_RUN_BUDGET
+
+# errors are recognized by class name rather than by class, because promptlayer proxies the openai module (and its
+# exceptions) and because the modal functions should not have to import openai just to classify an error
+RETRYABLE_ERRORS = {
+    "RateLimitError",
+    "APIConnectionError",
+    "ServiceUnavailableError",
+    "Timeout",
+    "TryAgain",
+    "TimeoutError",
+    "ConnectionError",
+    "ConnectionResetError",
+    "ServerDisconnectedError",
+    "ClientConnectionError",
+}
+FATAL_ERRORS = {
+    "InvalidRequestError",
+    "AuthenticationError",
+    "PermissionError",
+    "InvalidAPIType",
+    "SignatureVerificationError",
+}
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    return type(exc).__name__ == "RateLimitError" or getattr(exc, "http_status", None) == 429
+
+
+def is_retryable(exc: BaseException) -> bool:
+    name = type(exc).__name__
+    if name in FATAL_ERRORS:
+        return False
+    if name in RETRYABLE_ERRORS:
+        return True
+    http_status = getattr(exc, "http_status", None)
+    if http_status is not None:
+        return http_status in (408, 409, 429) or http_status >= 500
+    # openai raises a bare APIError for assorted server side hiccups, often without a status
+    return name == "APIError"
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds to wait according to the `Retry-After` header of the error's response, if there is one."""
+    headers = getattr(exc, "headers", None) or {}
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RetryBudget:
+    """A cap on the number of retries across all the requests of a run."""
+
+    def __init__(self, max_retries: int = RETRY_RUN_BUDGET) -> None:
+        self.max_retries = max_retries
+        self.spent = 0
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self.spent >= self.max_retries:
+                return False
+            self.spent += 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Retries retryable errors with exponential backoff and full jitter, honoring `Retry-After`, and gives up right
+    away on fatal errors (a bad model name or api key will not get better by waiting). Every request gets at most
+    `max_attempts` attempts, and every retry also has to be paid for from the run's `RetryBudget`, if there is one.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = RETRY_MAX_ATTEMPTS,
+        base_delay: float = RETRY_BASE_DELAY,
+        max_delay: float = RETRY_MAX_DELAY,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.calls = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.fatal = 0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int, exc: BaseException) -> float:
+        server_delay = retry_after(exc)
+        if server_delay is not None:
+            # a little jitter on top, so that everybody told to come back in 20s doesn't come back at once
+            return min(self.max_delay, server_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def _next_delay(
+        self,
+        attempt: int,
+        exc: BaseException,
+        budget: Optional[RetryBudget],
+        on_retry: Optional[Callable[[BaseException, float], None]],
+        log: Callable,
+    ) -> float:
+        """Delay before the next attempt, or re-raise if the error should not be retried."""
+        if not is_retryable(exc):
+            with self._lock:
+                self.fatal += 1
+            raise exc
+        if attempt + 1 >= self.max_attempts or (budget is not None and not budget.try_spend()):
+            with self._lock:
+                self.gave_up += 1
+            raise exc
+
+        delay = self.delay(attempt, exc)
+        with self._lock:
+            self.retries += 1
+        if on_retry:
+            on_retry(exc, delay)
+        log(f"Failed to generate response. Error: {exc}. Retrying in {delay:.1f}s...")
+        return delay
+
+    def call(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        budget: Optional[RetryBudget] = None,
+        on_retry: Optional[Callable[[BaseException, float], None]] = None,
+        log=print,
+        **kwargs,
+    ) -> Any:
+        with self._lock:
+            self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as exc:
+                time.sleep(self._next_delay(attempt, exc, budget, on_retry, log))
+            attempt += 1
+
+    async def acall(
+        self,
+        fn: Callable[..., Awaitable[Any]],
+        *args,
+        budget: Optional[RetryBudget] = None,
+        on_retry: Optional[Callable[[BaseException, float], None]] = None,
+        log=print,
+        **kwargs,
+    ) -> Any:
+        with self._lock:
+            self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as exc:
+                await asyncio.sleep(self._next_delay(attempt, exc, budget, on_retry, log))
+            attempt += 1
+
+    def stats(self) -> str:
+        return f"retries: {self.calls} calls, {self.retries} retries, {self.gave_up} gave up, {self.fatal} fatal"
+
+
+retry_policy = RetryPolicy()
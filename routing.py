@@ -0,0 +1,189 @@
+import ast
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Optional
+
+from batching import expected_tokens
+from constants import (
+    DEFAULT_CACHE_DIR,
+    ROUTE_FAST_MODEL,
+    ROUTE_MAX_FAILURE_RATE,
+    ROUTE_MIN_SAMPLES,
+    ROUTE_QUALITY_WINDOW,
+    ROUTE_SIMPLE_TOKENS,
+    ROUTE_TOKENS_PER_MENTION,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS routes (
+    id INTEGER PRIMARY KEY,
+    timestamp REAL NOT NULL,
+    run_id TEXT,
+    file TEXT NOT NULL,
+    file_type TEXT NOT NULL,
+    route TEXT NOT NULL,
+    model TEXT NOT NULL,
+    -- the attempt with the big model after the fast one failed validation
+    escalated INTEGER NOT NULL DEFAULT 0,
+    valid INTEGER NOT NULL,
+    latency REAL NOT NULL,
+    cost REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS routes_quality ON routes (file_type, model, timestamp);
+"""
+
+
+def file_type(filename: str) -> str:
+    return os.path.splitext(filename)[1].lower() or filename
+
+
+def validate(filename: str, code: str) -> Optional[str]:
+    """What is wrong with the generated code, as far as can be told without running it, None if nothing is."""
+    if not code.strip():
+        return "empty"
+    if code.lstrip().startswith("```"):
+        return "code fence"
+    extension = file_type(filename)
+    try:
+        if extension == ".py":
+            ast.parse(code)
+        elif extension == ".json":
+            json.loads(code)
+    except (SyntaxError, ValueError) as e:
+        return f"does not parse: {e}"
+    if extension in (".html", ".htm") and "<html" in code.lower() and "</html>" not in code.lower():
+        return "unclosed <html>"
+    return None
+
+
+class Router:
+    """
+    Picks the model every file is generated with. Files that are expected to be small and that few other files
+    depend on (a manifest.json, a stylesheet, an icon stub) go to the fast model, the rest, and file types the fast
+    model has recently been failing validation on, to the model the run asked for.
+
+    Routing is off unless `enabled`, and with `cascade` (the default once it is on) files routed to the fast model are
+    validated and generated again with the run's model if they fail. Every attempt is recorded with its route,
+    latency, cost and whether it passed validation in a SQLite file, which is where the failure rates come from, and
+    what to tune the constants in `constants.py` against.
+    """
+
+    def __init__(
+        self, path: str, fast_model: str = ROUTE_FAST_MODEL, enabled: bool = False, cascade: bool = True
+    ) -> None:
+        self.path = path
+        self.fast_model = fast_model
+        self.enabled = enabled
+        self.cascade = cascade
+        # opened on first use, not when the module is imported
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # the latest validation results by (file type, model), 1 for valid
+        self._quality: dict[tuple[str, str], deque] = defaultdict(lambda: deque(maxlen=ROUTE_QUALITY_WINDOW))
+        # per route in this process: attempts, failed validations, escalations, latency, cost
+        self._stats: dict[str, list] = defaultdict(lambda: [0, 0, 0, 0.0, 0.0])
+
+    @classmethod
+    def from_env(cls) -> "Router":
+        return cls(
+            path=os.environ.get("SMOL_ROUTES", os.path.join(DEFAULT_CACHE_DIR, "routes.sqlite")),
+            fast_model=os.environ.get("SMOL_FAST_MODEL", ROUTE_FAST_MODEL),
+            enabled=os.environ.get("SMOL_ROUTING", "0") == "1",
+            cascade=os.environ.get("SMOL_CASCADE", "1") != "0",
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens the file and loads the latest validation results from it, the first time either is needed."""
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._connection.executescript(SCHEMA)
+            rows = self._connection.execute(
+                "SELECT file_type, model, valid FROM routes ORDER BY timestamp DESC LIMIT ?",
+                (ROUTE_QUALITY_WINDOW * 50,),
+            ).fetchall()
+            for row_file_type, model, valid in reversed(rows):
+                self._quality[(row_file_type, model)].append(valid)
+        return self._connection
+
+    @staticmethod
+    def complexity(filename: str, shared_dependencies: str) -> int:
+        """The tokens the file is expected to come to, plus some for every mention in the shared dependencies."""
+        mentions = (shared_dependencies or "").count(os.path.basename(filename))
+        return expected_tokens(filename) + mentions * ROUTE_TOKENS_PER_MENTION
+
+    def failure_rate(self, filename: str, model: str) -> Optional[float]:
+        """The share of recent files of this type the model failed validation on, None without enough history."""
+        with self._lock:
+            self._connect()
+            results = list(self._quality.get((file_type(filename), model), ()))
+        if len(results) < ROUTE_MIN_SAMPLES:
+            return None
+        return 1 - sum(results) / len(results)
+
+    def route(self, filename: str, model: str, shared_dependencies: str) -> tuple[str, str]:
+        """The name of the route the file takes and the model to generate it with first."""
+        if not self.enabled or model == self.fast_model:
+            return "default", model
+        if self.complexity(filename, shared_dependencies) > ROUTE_SIMPLE_TOKENS:
+            return "complex", model
+        failure_rate = self.failure_rate(filename, self.fast_model)
+        if failure_rate is not None and failure_rate > ROUTE_MAX_FAILURE_RATE:
+            return "unreliable", model
+        return ("cascade" if self.cascade else "simple"), self.fast_model
+
+    def record(
+        self,
+        run_id: Optional[str],
+        filename: str,
+        route: str,
+        model: str,
+        valid: bool,
+        latency: float,
+        cost: float,
+        escalated: bool = False,
+    ) -> None:
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO routes (timestamp, run_id, file, file_type, route, model, escalated, valid, latency, "
+                "cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    run_id,
+                    filename,
+                    file_type(filename),
+                    route,
+                    model,
+                    int(escalated),
+                    int(valid),
+                    latency,
+                    cost,
+                ),
+            )
+            self._quality[(file_type(filename), model)].append(int(valid))
+            stats = self._stats[f"{route} ({model})"]
+            stats[0] += 1
+            stats[1] += not valid
+            stats[2] += escalated
+            stats[3] += latency
+            stats[4] += cost
+
+    def stats(self) -> str:
+        with self._lock:
+            stats = {route: list(route_stats) for route, route_stats in self._stats.items()}
+        if not stats:
+            return "routing: no files"
+        lines = ["routing:"]
+        for route, (attempts, invalid, escalated, latency, route_cost) in sorted(stats.items()):
+            lines.append(
+                f"  {route}: {attempts} files, {invalid} failed validation, {escalated} escalated, "
+                f"mean {latency / attempts:.2f}s, ${route_cost:.4f}"
+            )
+        return "\n".join(lines)
+
+
+router = Router.from_env()
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Optional
+
+from constants import DEFAULT_CACHE_DIR, EXTENSION_TO_SKIP
+from token_counter import count_tokens, estimate_tokens
+
+SUMMARY_MAX_PATHS = 5
+BOMS = [
+    (b"\xef\xbb\xbf", "utf-8-sig"),
+    (b"\xff\xfe", "utf-16"),
+    (b"\xfe\xff", "utf-16"),
+]
+
+
+@dataclass
+class ScanChanges:
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.removed)
+
+    def summary(self) -> str:
+        if not self:
+            return "no files changed since the last run"
+        parts = []
+        for kind, paths in (("added", self.added), ("modified", self.modified), ("removed", self.removed)):
+            if paths:
+                shown = ", ".join(paths[:SUMMARY_MAX_PATHS]) + (", ..." if len(paths) > SUMMARY_MAX_PATHS else "")
+                parts.append(f"{len(paths)} {kind} ({shown})")
+        return "changed since the last run: " + ", ".join(parts)
+
+
+def decode(data: bytes) -> tuple[str, str]:
+    """Returns the text and the encoding it was detected to be in."""
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data.decode(encoding), encoding
+    if b"\0" in data:
+        raise ValueError("looks like a binary file")
+    try:
+        return data.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError:
+        # latin-1 decodes anything, which is good enough to show the file to a model
+        return data.decode("latin-1"), "latin-1"
+
+
+class ScanIndex:
+    """
+    A persistent index of a directory's files for the debuggers, keyed by path, mtime and size. It keeps the contents,
+    the detected encoding and the token count per model of every file, so repeated runs only read (and count) the
+    files that changed, and it can tell what changed since the last run.
+    """
+
+    def __init__(self, directory: str, cache_dir: str = DEFAULT_CACHE_DIR) -> None:
+        self.directory = directory
+        directory_hash = hashlib.sha256(os.path.abspath(directory).encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, "scan", directory_hash + ".json")
+        self.entries: dict[str, dict] = {}
+        self.changes = ScanChanges()
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def scan(self, model: Optional[str] = None) -> dict[str, str]:
+        """
+        Brings the index up to date, and the token counts for `model` with it if one is given, and returns the contents
+        of all the files, by relative path. The index is only written back if anything in it changed.
+        """
+        previous = self.entries
+        self.entries = {}
+        self.changes = ScanChanges()
+
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if any(filename.endswith(ext) for ext in EXTENSION_TO_SKIP) or filename.startswith(".smol"):
+                    continue
+                file_path = os.path.join(dirpath, filename)
+                relative_filepath = os.path.relpath(file_path, self.directory)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+
+                entry = previous.get(relative_filepath)
+                if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    self.entries[relative_filepath] = entry
+                    continue
+
+                if entry is None:
+                    self.changes.added.append(relative_filepath)
+                else:
+                    self.changes.modified.append(relative_filepath)
+                try:
+                    with open(file_path, "rb") as file:
+                        content, encoding = decode(file.read())
+                except Exception as e:
+                    content, encoding = f"Error reading file {filename}: {str(e)}", None
+                self.entries[relative_filepath] = {
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "encoding": encoding,
+                    "content": content,
+                    "tokens": {},
+                }
+
+        self.changes.removed = sorted(previous.keys() - self.entries.keys())
+        counted = model is not None and self._count_tokens(model)
+        if self.changes or counted:
+            self.save()
+        return {path: entry["content"] for path, entry in self.entries.items()}
+
+    def _count_tokens(self, model: str) -> bool:
+        """Counts the tokens of the files that have no count for the model yet, returns whether there were any."""
+        counted = False
+        for entry in self.entries.values():
+            if model not in entry["tokens"]:
+                entry["tokens"][model] = count_tokens(entry["content"], model)
+                counted = True
+        return counted
+
+    def tokens(self, model: str) -> dict[str, int]:
+        """The token count of every file, estimated for the files `scan` didn't count them for the model."""
+        return {
+            path: entry["tokens"][model] if model in entry["tokens"] else estimate_tokens(entry["content"])
+            for path, entry in self.entries.items()
+        }
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from constants import DEFAULT_MAX_IN_FLIGHT, MODEL_RATE_LIMITS
+
+WINDOW = 60.0 # seconds, both budgets are per minute
+DEFAULT_RATE_LIMIT_PAUSE = 5.0 # seconds, when a 429 doesn't say how long to back off for
+
+
+class _ModelState:
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int, concurrency_limit: int) -> None:
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.concurrency_limit = concurrency_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.rate_limited = 0
+        self.paused_until = 0.0
+        # (timestamp, tokens) of every request admitted within the last minute
+        self.window: deque[tuple[float, int]] = deque()
+
+    def wait_time(self, tokens: int, now: float) -> Optional[float]:
+        """None if a request of this size can be admitted right now, otherwise how long to wait before rechecking."""
+        while self.window and now - self.window[0][0] >= WINDOW:
+            self.window.popleft()
+
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= self.concurrency_limit:
+            # a release will wake us up
+            return WINDOW
+        if self.window:
+            if len(self.window) >= self.requests_per_minute:
+                return self.window[0][0] + WINDOW - now
+            # a request bigger than the whole budget is still let through once the window is empty
+            if sum(window_tokens for _, window_tokens in self.window) + tokens > self.tokens_per_minute:
+                return self.window[0][0] + WINDOW - now
+        return None
+
+
+class RateLimitScheduler:
+    """
+    Admits OpenAI requests at a rate the provider can sustain.
+
+    There is a global cap on requests in flight, and every model has its own tokens-per-minute and
+    requests-per-minute budget (estimated prompt tokens plus `max_tokens` are charged when a request is admitted).
+    When a request gets rate limited, the model's concurrency limit is halved and the model is paused for the
+    duration of `Retry-After`; every run of successful requests then raises the limit by one again (AIMD).
+    """
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, rate_limits: dict = None) -> None:
+        self.max_in_flight = max_in_flight
+        self.rate_limits = MODEL_RATE_LIMITS if rate_limits is None else rate_limits
+        self._in_flight = 0
+        self._models: dict[str, _ModelState] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    @classmethod
+    def from_env(cls) -> "RateLimitScheduler":
+        return cls(max_in_flight=int(os.environ.get("SMOL_MAX_IN_FLIGHT", DEFAULT_MAX_IN_FLIGHT)))
+
+    def _model(self, model: str) -> _ModelState:
+        state = self._models.get(model)
+        if state is None:
+            tokens_per_minute, requests_per_minute = self.rate_limits.get(model, self.rate_limits["default"])
+            state = self._models[model] = _ModelState(tokens_per_minute, requests_per_minute, self.max_in_flight)
+        return state
+
+    @asynccontextmanager
+    async def slot(self, model: str, tokens: int) -> AsyncIterator[None]:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        state = self._model(model)
+
+        async with self._condition:
+            while True:
+                now = time.monotonic()
+                wait_time = WINDOW if self._in_flight >= self.max_in_flight else state.wait_time(tokens, now)
+                if wait_time is None:
+                    break
+                try:
+                    await asyncio.wait_for(self._condition.wait(), timeout=wait_time)
+                except asyncio.TimeoutError:
+                    pass
+            self._in_flight += 1
+            state.in_flight += 1
+            state.window.append((now, tokens))
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                state.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self, model: str) -> None:
+        state = self._model(model)
+        state.successes += 1
+        if state.successes >= state.concurrency_limit and state.concurrency_limit < self.max_in_flight:
+            state.concurrency_limit += 1
+            state.successes = 0
+
+    def on_rate_limited(self, model: str, retry_after: Optional[float] = None) -> None:
+        state = self._model(model)
+        state.rate_limited += 1
+        state.successes = 0
+        state.concurrency_limit = max(1, state.concurrency_limit // 2)
+        pause = DEFAULT_RATE_LIMIT_PAUSE if retry_after is None else retry_after
+        state.paused_until = max(state.paused_until, time.monotonic() + pause)
+
+    def stats(self) -> str:
+        return "scheduler: " + ", ".join(
+            f"{model} concurrency limit {state.concurrency_limit}, {state.rate_limited} rate limited"
+            for model, state in self._models.items()
+        )
+
+
+scheduler = RateLimitScheduler.from_env()
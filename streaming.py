@@ -0,0 +1,58 @@
+import time
+from typing import Optional
+
+STREAM_COALESCE_CHARS = 200 # don't push a delta downstream for every token...
+STREAM_COALESCE_INTERVAL = 0.5 # ...but don't sit on one for longer than this many seconds either
+PROGRESS_INTERVAL = 5.0 # seconds between progress reports to the user
+
+
+class StreamCoalescer:
+    """Merges many tiny streamed deltas into fewer, bigger chunks."""
+
+    def __init__(self, min_chars: int = STREAM_COALESCE_CHARS, interval: float = STREAM_COALESCE_INTERVAL) -> None:
+        self.min_chars = min_chars
+        self.interval = interval
+        self._parts: list[str] = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, delta: str) -> Optional[str]:
+        """Returns a chunk when it is time to push one, otherwise None."""
+        self._parts.append(delta)
+        self._size += len(delta)
+        if self._size >= self.min_chars or time.monotonic() - self._last_flush >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        chunk = "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        return chunk or None
+
+
+class ProgressReporter:
+    """Keeps track of how far along every file of a run is and produces a summary every `interval` seconds."""
+
+    def __init__(self, total_files: int, interval: float = PROGRESS_INTERVAL) -> None:
+        self.total_files = total_files
+        self.interval = interval
+        self.chars: dict[str, int] = {}
+        self.finished: list[str] = []
+        self._last_report = time.monotonic()
+
+    def update(self, file: str, chars: int) -> Optional[str]:
+        self.chars[file] = chars
+        if time.monotonic() - self._last_report < self.interval:
+            return None
+        self._last_report = time.monotonic()
+        in_progress = len(self.chars.keys() - set(self.finished))
+        return (
+            f"{len(self.finished)}/{self.total_files} files done, {in_progress} in progress, "
+            f"{sum(self.chars.values())} characters generated so far"
+        )
+
+    def finish(self, file: str) -> str:
+        self.finished.append(file)
+        return f"{file} is ready ({len(self.finished)}/{self.total_files})"
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResponseCache  # noqa: E402
+
+PARAMS = {"model": "gpt-4", "messages": [{"role": "user", "content": "hi"}], "max_tokens": 256, "temperature": 0}
+
+
+class OwnerGone(Exception):
+    pass
+
+
+def test_identical_requests_in_flight_make_one_call(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "reply"
+
+    async def run():
+        replies = await asyncio.gather(*(cache.aget_or_create(PARAMS, create) for _ in range(3)))
+        # stored once the call is done, the next one is a hit
+        return replies, await cache.aget_or_create(PARAMS, create)
+
+    replies, later = asyncio.run(run())
+    assert replies == ["reply"] * 3
+    assert later == "reply"
+    assert len(calls) == 1
+    assert (cache.misses, cache.collapsed, cache.hits) == (1, 2, 1)
+
+
+def test_waiter_makes_the_call_itself_when_the_owner_fails_for_its_own_reasons(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    started = asyncio.Event()
+
+    async def owner_create():
+        started.set()
+        await asyncio.sleep(0.01)
+        raise OwnerGone()
+
+    async def waiter_create():
+        return "reply"
+
+    async def run():
+        owner = asyncio.create_task(cache.aget_or_create(PARAMS, owner_create, owner_errors=(OwnerGone,)))
+        await started.wait()
+        waiter = cache.aget_or_create(PARAMS, waiter_create, owner_errors=(OwnerGone,))
+        return await asyncio.gather(owner, waiter, return_exceptions=True)
+
+    owner_result, waiter_result = asyncio.run(run())
+    assert isinstance(owner_result, OwnerGone)
+    assert waiter_result == "reply"
+    assert cache.collapsed == 1
+
+
+def test_other_errors_reach_the_collapsed_requests_too(tmp_path):
+    cache = ResponseCache(directory=str(tmp_path))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("bad request")
+
+    async def run():
+        return await asyncio.gather(
+            *(cache.aget_or_create(PARAMS, create, owner_errors=(OwnerGone,)) for _ in range(2)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len(calls) == 1
+
+
+def test_unknown_mode_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        ResponseCache(directory=str(tmp_path), mode="sometimes")
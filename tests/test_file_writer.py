@@ -0,0 +1,124 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_writer import OutputTree  # noqa: E402
+
+
+def read(path):
+    with open(path) as file:
+        return file.read()
+
+
+def test_staged_writes_show_up_together_on_commit(tmp_path):
+    directory = tmp_path / "out"
+    directory.mkdir()
+    (directory / "old.txt").write_text("old")
+
+    async def run():
+        tree = OutputTree(str(directory))
+        await tree.begin()
+        await tree.write("src/new.js", "new")
+        await tree.write("old.txt", "changed")
+        # nothing in the directory itself changes before the commit
+        assert not (directory / "src").exists()
+        assert read(directory / "old.txt") == "old"
+        await tree.commit()
+        return tree
+
+    tree = asyncio.run(run())
+    assert read(directory / "src" / "new.js") == "new"
+    assert read(directory / "old.txt") == "changed"
+    assert not os.path.exists(tree.root)
+    # neither the staging tree nor the old directory is left next to it
+    assert os.listdir(tmp_path) == ["out"]
+
+
+def test_abort_leaves_the_directory_as_it_was(tmp_path):
+    directory = tmp_path / "out"
+    directory.mkdir()
+    (directory / "old.txt").write_text("old")
+
+    async def run():
+        tree = OutputTree(str(directory))
+        await tree.begin()
+        await tree.write("old.txt", "changed")
+        await tree.abort()
+
+    asyncio.run(run())
+    assert os.listdir(directory) == ["old.txt"]
+    assert read(directory / "old.txt") == "old"
+    assert os.listdir(tmp_path) == ["out"]
+
+
+def test_runs_on_the_same_directory_take_turns(tmp_path):
+    directory = str(tmp_path / "out")
+    events = []
+
+    async def run_tree(name, content):
+        tree = OutputTree(directory)
+        await tree.begin()
+        events.append(f"{name} began")
+        await tree.write("file.txt", content)
+        await asyncio.sleep(0.01)
+        events.append(f"{name} committed")
+        await tree.commit()
+
+    async def run():
+        await asyncio.gather(run_tree("first", "1"), run_tree("second", "2"))
+
+    asyncio.run(run())
+    assert events == ["first began", "first committed", "second began", "second committed"]
+    assert read(os.path.join(directory, "file.txt")) == "2"
+
+
+def test_runs_on_different_directories_do_not_wait_for_each_other(tmp_path):
+    events = []
+
+    async def run_tree(name):
+        tree = OutputTree(str(tmp_path / name))
+        await tree.begin()
+        events.append(f"{name} began")
+        await asyncio.sleep(0.01)
+        await tree.commit()
+
+    async def run():
+        await asyncio.gather(run_tree("a"), run_tree("b"))
+
+    asyncio.run(run())
+    assert events == ["a began", "b began"]
+
+
+def test_staging_leftovers_of_crashed_runs_are_swept(tmp_path):
+    directory = tmp_path / "out"
+    directory.mkdir()
+    crashed = tmp_path / f".out.staging-{os.getpid()}-crashed"
+    crashed.mkdir()
+    # the staging tree of another process that is still running is left alone
+    running = tmp_path / f".out.staging-{os.getppid()}-running"
+    running.mkdir()
+
+    async def run():
+        tree = OutputTree(str(directory))
+        await tree.begin()
+        await tree.abort()
+
+    asyncio.run(run())
+    assert not crashed.exists()
+    assert running.exists()
+
+
+def test_unstaged_tree_writes_in_place(tmp_path):
+    directory = tmp_path / "out"
+
+    async def run():
+        tree = OutputTree(str(directory), staged=False)
+        await tree.begin()
+        await tree.write("a/b.txt", "b")
+        assert read(directory / "a" / "b.txt") == "b"
+        await tree.commit()
+
+    asyncio.run(run())
+    assert os.listdir(tmp_path) == ["out"]
@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from job_queue import JobQueue  # noqa: E402
+
+
+def test_users_take_turns_after_their_job_started():
+    queue = JobQueue(max_runs=1, max_runs_per_user=1)
+    a1 = queue.submit("a")
+    a2 = queue.submit("a")
+    b1 = queue.submit("b")
+    assert a1.started is not None
+    assert queue.position(b1) == 1
+    assert queue.position(a2) == 2
+
+    queue.done(a1)
+    # a just had a turn, so b goes next even though a2 was queued first
+    assert b1.started is not None
+    assert a2.started is None
+
+    queue.done(b1)
+    assert a2.started is not None
+
+
+def test_new_user_goes_ahead_of_a_user_who_had_a_turn():
+    queue = JobQueue(max_runs=1, max_runs_per_user=1)
+    a1 = queue.submit("a")
+    b1 = queue.submit("b")
+    queue.done(a1)
+    a2 = queue.submit("a")
+    c1 = queue.submit("c")
+    queue.done(b1)
+    assert c1.started is not None
+    assert a2.started is None
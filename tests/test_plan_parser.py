@@ -0,0 +1,56 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plan_parser import PlanParseError, extract_filepaths, normalize_path  # noqa: E402
+
+EXPECTED = ["manifest.json", "popup.html", "src/popup.js"]
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "['manifest.json', 'popup.html', 'src/popup.js']",
+        'Here is the plan:\n```json\n["manifest.json", "popup.html", "src/popup.js"]\n```\nLet me know!',
+        "The files:\n- `manifest.json`: the manifest\n- popup.html\n- ./src/popup.js (the popup's logic)",
+        "1. manifest.json\n2. popup.html\n3. src\\popup.js",
+        "manifest.json\npopup.html\nsrc/popup.js",
+    ],
+)
+def test_plan_formats(text):
+    assert extract_filepaths(text) == EXPECTED
+
+
+def test_duplicates_are_dropped_in_plan_order():
+    assert extract_filepaths("['popup.html', 'manifest.json', './popup.html']") == ["popup.html", "manifest.json"]
+
+
+@pytest.mark.parametrize(
+    "path", ["../secrets.txt", "src/../../outside.js", "C:\\Windows\\evil.dll", "src/", ".", "a\0b.js"]
+)
+def test_paths_outside_the_output_directory_are_dropped(path):
+    assert normalize_path(path) is None
+
+
+def test_absolute_paths_are_made_relative():
+    assert normalize_path("/etc/app.conf") == "etc/app.conf"
+
+
+@pytest.mark.parametrize("path", ["prompt used for this extension.md", "assets/my icon.png", "Makefile"])
+def test_file_names_with_spaces_are_kept(path):
+    assert normalize_path(path) == path
+
+
+@pytest.mark.parametrize(
+    "line", ["Here are the files you will need", "and this is the last one of the files, style.css for the popup"]
+)
+def test_prose_is_not_a_path(line):
+    assert normalize_path(line) is None
+
+
+def test_plan_without_paths_raises():
+    with pytest.raises(PlanParseError):
+        extract_filepaths("I could not come up with a plan, sorry.")
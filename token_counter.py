@@ -0,0 +1,52 @@
+import asyncio
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+# counting tokens is only needed for reporting, set SMOL_COUNT_TOKENS=0 to skip it altogether (it is also skipped
+# when tiktoken is not installed, which is the case for the modal variants)
+COUNT_TOKENS = os.environ.get("SMOL_COUNT_TOKENS", "1") != "0" and importlib.util.find_spec("tiktoken") is not None
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="token_counter")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """Building an encoder is expensive, so there is only ever one per model."""
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # a model tiktoken doesn't know about yet (a fine-tune, for example)
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(messages: list[dict], model: str) -> list[int]:
+    return [count_tokens(message["content"], model) for message in messages]
+
+
+async def acount_message_tokens(messages: list[dict], model: str) -> list[int]:
+    """Same as `count_message_tokens`, but the encoding happens in a worker thread, off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_executor, count_message_tokens, messages, model)
+
+
+def report_tokens(messages: list[dict], token_counts: list[int], log=print) -> None:
+    for message, token_count in zip(messages, token_counts):
+        prompt = message["content"]
+        # print number of tokens in light gray, with first 50 characters of prompt in green. if truncated, show that
+        # it is truncated
+        log(
+            "\033[37m" + str(token_count) + " tokens\033[0m" + " in prompt: " + "\033[92m" +
+            prompt[:50] + "\033[0m" + ("..." if len(prompt) > 50 else "")
+        )
+
+
+def estimate_tokens(text: str) -> int:
+    """A rough estimate (~4 characters per token) for when an exact count is not worth the encoding."""
+    return len(text) // 4 + 1
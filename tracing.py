@@ -0,0 +1,264 @@
+import atexit
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, Optional
+
+from file_writer import io_executor
+
+# upper bounds in seconds, from a cache hit up to a long gpt-4 file
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# finished spans are written to the trace file in batches, whichever of the two comes first
+TRACE_FLUSH_SPANS = 200
+TRACE_FLUSH_INTERVAL = 5.0 # seconds
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+
+
+@dataclass
+class Span:
+    name: str
+    kind: str
+    trace_id: str
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    parent_id: Optional[str] = None
+    start: float = field(default_factory=time.time)
+    duration: Optional[float] = None
+    status: str = "ok"
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def add(self, name: str, amount: float = 1) -> None:
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket the quantile falls into, which is as precise as a histogram gets."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return float("inf")
+
+
+class Tracer:
+    """
+    Spans for every bot invocation, pipeline stage and OpenAI request. The span of the innermost `with tracer.span()`
+    is the parent of new spans (through a context variable, so it follows asyncio tasks). Finished spans feed latency
+    histograms per stage and model, and optionally go to a JSONL file and/or a Prometheus-style /metrics endpoint.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None, metrics_port: Optional[int] = None) -> None:
+        self.trace_file = trace_file
+        self.metrics_port = metrics_port
+        # (stage, model) -> durations, model -> queue waits, (model, kind) -> tokens
+        self.latency: dict[tuple[str, str], Histogram] = {}
+        self.queue_wait: dict[str, Histogram] = {}
+        self.tokens: dict[tuple[str, str], int] = {}
+        self.retries: dict[str, int] = {}
+        self._lock = threading.Lock()
+        # trace file lines not written yet, and the lock that keeps batches from interleaving in the file
+        self._pending: list[str] = []
+        self._last_flush = time.monotonic()
+        self._write_lock = threading.Lock()
+        if trace_file:
+            atexit.register(self.flush)
+        self._metrics_server: Optional[ThreadingHTTPServer] = None
+        if metrics_port is not None:
+            self.serve_metrics(metrics_port)
+
+    @classmethod
+    def from_env(cls) -> "Tracer":
+        metrics_port = os.environ.get("SMOL_METRICS_PORT")
+        return cls(
+            trace_file=os.environ.get("SMOL_TRACE_FILE"),
+            metrics_port=int(metrics_port) if metrics_port else None,
+        )
+
+    @contextmanager
+    def span(
+        self, name: str, kind: str = "internal", trace_id: Optional[str] = None, **attributes: Any
+    ) -> Iterator[Span]:
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            kind=kind,
+            trace_id=trace_id or (parent.trace_id if parent else uuid.uuid4().hex),
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "cancelled" if type(e).__name__ == "CancelledError" else "error"
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            _current_span.reset(token)
+            self._finish(span)
+
+    def _finish(self, span: Span) -> None:
+        model = span.attributes.get("model", "")
+        with self._lock:
+            self.latency.setdefault((span.name, model), Histogram()).observe(span.duration)
+            if "queue_wait" in span.attributes:
+                self.queue_wait.setdefault(model, Histogram()).observe(span.attributes["queue_wait"])
+            for kind in ("prompt_tokens", "completion_tokens"):
+                if span.attributes.get(kind) and span.kind == "openai":
+                    self.tokens[(model, kind)] = self.tokens.get((model, kind), 0) + span.attributes[kind]
+            if span.attributes.get("retries") and span.kind == "bot":
+                self.retries[model] = self.retries.get(model, 0) + span.attributes["retries"]
+            if not self.trace_file:
+                return
+            self._pending.append(json.dumps(span.to_dict(), default=str) + "\n")
+            if len(self._pending) < TRACE_FLUSH_SPANS and time.monotonic() - self._last_flush < TRACE_FLUSH_INTERVAL:
+                return
+            lines = self._take_pending()
+        # spans finish on the event loop, the file is written on the I/O executor
+        io_executor.submit(self._write, lines)
+
+    def flush(self) -> None:
+        """Writes the spans that are still buffered to the trace file."""
+        with self._lock:
+            lines = self._take_pending()
+        self._write(lines)
+
+    def _take_pending(self) -> list[str]:
+        lines, self._pending = self._pending, []
+        self._last_flush = time.monotonic()
+        return lines
+
+    def _write(self, lines: list[str]) -> None:
+        if not lines:
+            return
+        with self._write_lock:
+            with open(self.trace_file, "a", encoding="utf-8") as file:
+                file.writelines(lines)
+
+    def metrics(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            _histogram_lines(
+                lines, "smol_span_duration_seconds", "Duration of bot invocations, stages and OpenAI requests",
+                {(("stage", stage), ("model", model)): histogram for (stage, model), histogram in self.latency.items()},
+            )
+            _histogram_lines(
+                lines, "smol_queue_wait_seconds", "Time OpenAI requests waited for the rate limit scheduler",
+                {(("model", model),): histogram for model, histogram in self.queue_wait.items()},
+            )
+            lines.append("# HELP smol_tokens_total Tokens sent to and received from OpenAI")
+            lines.append("# TYPE smol_tokens_total counter")
+            for (model, kind), tokens in self.tokens.items():
+                lines.append(f'smol_tokens_total{{model="{model}",kind="{kind}"}} {tokens}')
+            lines.append("# HELP smol_retries_total Retried OpenAI requests")
+            lines.append("# TYPE smol_retries_total counter")
+            for model, retries in self.retries.items():
+                lines.append(f'smol_retries_total{{model="{model}"}} {retries}')
+        return "\n".join(lines) + "\n"
+
+    def serve_metrics(self, port: int) -> None:
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                body = tracer.metrics().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._metrics_server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        self._metrics_server.daemon_threads = True
+        threading.Thread(target=self._metrics_server.serve_forever, name="metrics", daemon=True).start()
+
+    def stats(self) -> str:
+        with self._lock:
+            return "latency: " + ", ".join(
+                f"{stage}{f' ({model})' if model else ''} n={histogram.count} "
+                f"p50<={histogram.quantile(0.5)}s p95<={histogram.quantile(0.95)}s"
+                for (stage, model), histogram in sorted(self.latency.items())
+            )
+
+
+def _histogram_lines(lines: list[str], name: str, help_text: str, histograms: dict) -> None:
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in histograms.items():
+        label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else str(bound)
+            lines.append(f'{name}_bucket{{{label_text},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def trace_bot(name: str):
+    """Runs every invocation of a bot in a span, traced under the run id of the request if it carries one."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(context) -> None:
+            content = context.request.content
+            if not isinstance(content, dict):
+                content = {}
+            attributes = {key: content[key] for key in ("model", "file") if key in content}
+            with tracer.span(name, kind="bot", trace_id=content.get("run_id"), **attributes):
+                await fn(context)
+
+        return wrapper
+
+    return decorator
+
+
+tracer = Tracer.from_env()
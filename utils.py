@@ -11,4 +11,35 @@ def clean_dir(directory):
                 if extension not in EXTENSION_TO_SKIP:
                     os.remove(os.path.join(dirpath, filename))
     else:
-        os.makedirs(directory, exist_ok=True)
\ No newline at end of file
+        os.makedirs(directory, exist_ok=True)
+
+def remove_stale_files(directory, keep):
+    # like clean_dir, but the files we are keeping (and our own .smol* bookkeeping files) are left alone
+    keep = {os.path.normpath(os.path.join(directory, filename)) for filename in keep}
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+        return
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            _, extension = os.path.splitext(filename)
+            if extension in EXTENSION_TO_SKIP or filename.startswith(".smol"):
+                continue
+            if os.path.normpath(file_path) not in keep:
+                os.remove(file_path)
+
+
+def chunk_by_tokens(items, budget):
+    # greedily packs (item, tokens) pairs into chunks of at most `budget` tokens, keeping the order (so that files
+    # from the same directory end up together). an item bigger than the whole budget gets a chunk of its own
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for item, tokens in items:
+        if chunk and chunk_tokens + tokens > budget:
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(item)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks